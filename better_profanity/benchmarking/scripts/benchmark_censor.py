@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+Censor benchmark
+
+Times Profanity.censor over a corpus of real posts and checks that the compiled
+wordset gives the same output as the plain list of VaryingStrings it replaced.
+
+Usage (from the server directory):
+    python better_profanity/benchmarking/scripts/benchmark_censor.py [posts.txt]
+
+Without a file, the latest home posts are read from the local MongoDB.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..")))
+
+from better_profanity import Profanity
+from better_profanity.varying_string import VaryingString
+
+CORPUS_SIZE = 5000
+
+
+def load_corpus():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding="utf-8") as f:
+            return [line.rstrip("\n") for line in f if line.strip() != ""]
+
+    import pymongo
+
+    db = pymongo.MongoClient("mongodb://localhost:27017")["meowerserver"]
+    posts = db["posts"].find({"post_origin": "home"}, {"p": 1}).sort("t.e", pymongo.DESCENDING).limit(CORPUS_SIZE)
+    return [post["p"] for post in posts]
+
+
+def run(profanity, corpus):
+    start = time.perf_counter()
+    output = [profanity.censor(post) for post in corpus]
+    return output, time.perf_counter() - start
+
+
+corpus = load_corpus()
+print("Loaded {0} posts ({1} chars)".format(len(corpus), sum(len(post) for post in corpus)))
+
+compiled = Profanity()
+reference = Profanity()
+reference.CENSOR_WORDSET = [VaryingString(word, char_map=reference.CHARS_MAPPING) for word in compiled.CENSOR_WORDSET]
+
+compiled_output, compiled_time = run(compiled, corpus)
+reference_output, reference_time = run(reference, corpus)
+
+mismatches = [post for post, a, b in zip(corpus, compiled_output, reference_output) if a != b]
+for post in mismatches[:10]:
+    print("Mismatch: {0!r}".format(post))
+
+print("VaryingString list: {0:.3f}s ({1:.3f}ms/post)".format(reference_time, reference_time * 1000 / max(len(corpus), 1)))
+print("VaryingWordSet:     {0:.3f}s ({1:.3f}ms/post)".format(compiled_time, compiled_time * 1000 / max(len(corpus), 1)))
+print("Speedup: {0:.1f}x, mismatches: {1}".format(reference_time / max(compiled_time, 1e-9), len(mismatches)))
+sys.exit(1 if mismatches else 0)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+Censor latency microbenchmark
+
+Reports per-post Profanity.censor latency for 50, 360 (the post length limit)
+and 1000 character inputs.
+
+Usage (from the server directory):
+    python better_profanity/benchmarking/scripts/benchmark_censor_latency.py
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..")))
+
+from better_profanity import Profanity
+
+SIZES = [50, 360, 1000]
+POSTS_PER_SIZE = 500
+VOCABULARY = (
+    "hello meower this is my post about cats and dogs lol did you see the new update "
+    "i love this place what are you doing today @someone check it out!! ok, bye :)"
+).split(" ")
+
+
+def make_post(size, swear_words):
+    words = []
+    length = 0
+    while length < size:
+        if random.random() < 0.05:
+            word = random.choice(swear_words)
+        else:
+            word = random.choice(VOCABULARY)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+random.seed(0)
+profanity = Profanity()
+swear_words = sorted(profanity.CENSOR_WORDSET)
+
+for size in SIZES:
+    posts = [make_post(size, swear_words) for i in range(POSTS_PER_SIZE)]
+    timings = []
+    for post in posts:
+        start = time.perf_counter()
+        profanity.censor(post)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(
+        "{0:>5} chars: mean {1:.3f}ms, p50 {2:.3f}ms, p99 {3:.3f}ms".format(
+            size,
+            sum(timings) * 1000 / len(timings),
+            timings[len(timings) // 2] * 1000,
+            timings[int(len(timings) * 0.99)] * 1000,
+        )
+    )
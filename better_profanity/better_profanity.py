@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
 
 from collections.abc import Iterable
+from multiprocessing import Pool
 
 from .constants import ALLOWED_CHARACTERS, ALLOWED_CONTANING_PROFANITY
 from .utils import (
-    any_next_words_form_swear_word,
     get_complete_path_of_file,
     get_replacement_for_swear_word,
     read_wordlist,
 )
-from .varying_string import VaryingString
+from .varying_word_set import VaryingWordSet
+
+# Profanity instance used by each worker process of `censor_many`
+_worker_profanity = None
+
+
+def _init_worker(profanity):
+    global _worker_profanity
+    _worker_profanity = profanity
+
+
+def _censor_chunk(args):
+    texts, censor_char = args
+    return [_worker_profanity._hide_swear_words(text, censor_char) for text in texts]
 
 
 class Profanity:
@@ -29,7 +42,7 @@ class Profanity:
             and not isinstance(words, Iterable)
         ):
             raise TypeError("words must be of type str, list, or None")
-        self.CENSOR_WORDSET = []
+        self.CENSOR_WORDSET = VaryingWordSet()
         self.CHARS_MAPPING = {
             "a": ("a", "@", "*", "4"),
             "i": ("i", "*", "l", "1"),
@@ -86,12 +99,56 @@ class Profanity:
                 "Function 'add_censor_words' only accepts list, tuple or set."
             )
         for w in custom_words:
-            self.CENSOR_WORDSET.append(VaryingString(w, char_map=self.CHARS_MAPPING))
+            self.CENSOR_WORDSET.add(w)
 
     def contains_profanity(self, text):
         """Return True if  the input text has any swear words."""
         return text != self.censor(text)
 
+    def censor_many(self, texts, censor_char="*", processes=1, chunksize=500):
+        """
+        Replace the swear words in each of the texts with `censor_char`.
+
+        Args:
+            texts (Iterable): Texts to censor.
+            processes (int): Number of worker processes to censor the texts
+                with, or `None` for one per CPU. Batches no larger than
+                `chunksize` are always censored in this process.
+            chunksize (int): Number of texts sent to a worker at a time.
+
+        Returns:
+            list: The censored texts, in the same order as `texts`.
+        """
+        texts = [text if isinstance(text, str) else str(text) for text in texts]
+        if not isinstance(censor_char, str):
+            censor_char = str(censor_char)
+
+        if not self.CENSOR_WORDSET:
+            self.load_censor_words()
+
+        if processes == 1 or len(texts) <= chunksize:
+            return [self._hide_swear_words(text, censor_char) for text in texts]
+
+        # The wordset is only sent once to each worker, not with every chunk
+        chunks = [
+            (texts[index : index + chunksize], censor_char)
+            for index in range(0, len(texts), chunksize)
+        ]
+        with Pool(processes, initializer=_init_worker, initargs=(self,)) as pool:
+            censored_chunks = pool.map(_censor_chunk, chunks)
+        return [text for chunk in censored_chunks for text in chunk]
+
+    def contains_profanity_many(self, texts, **kwargs):
+        """
+        Return a list of whether each of the texts has any swear words.
+        Takes the same keyword arguments as `censor_many`.
+        """
+        texts = list(texts)
+        return [
+            text != censored
+            for text, censored in zip(texts, self.censor_many(texts, **kwargs))
+        ]
+
     ## PRIVATE ##
 
     def _populate_words_to_wordset(self, words, *, whitelist_words=None):
@@ -116,7 +173,7 @@ class Profanity:
 
         # Populate the words into an internal wordset
         whitelist_words = set(whitelist_words)
-        all_censor_words = []
+        all_censor_words = VaryingWordSet(char_map=self.CHARS_MAPPING)
         for word in set(words):
             # All words in CENSOR_WORDSET must be in lowercase
             word = word.lower()
@@ -128,9 +185,9 @@ class Profanity:
             if num_of_non_allowed_chars > self.MAX_NUMBER_COMBINATIONS:
                 self.MAX_NUMBER_COMBINATIONS = num_of_non_allowed_chars
 
-            all_censor_words.append(VaryingString(word, char_map=self.CHARS_MAPPING))
+            all_censor_words.add(word)
 
-        # The default wordlist takes ~5MB+ of memory
+        # Compiled into a trie, so lookups don't scan the whole wordlist
         self.CENSOR_WORDSET = all_censor_words
 
     def _count_non_allowed_characters(self, word):
@@ -140,90 +197,54 @@ class Profanity:
                 count += 1
         return count
 
-    def _update_next_words_indices(self, text, words_indices, start_idx):
-        """Return a list of next words_indices after the input index."""
-        if not words_indices:
-            words_indices = self._get_next_words(
-                text, start_idx, self.MAX_NUMBER_COMBINATIONS
-            )
-        else:
-            del words_indices[:2]
-            if words_indices and words_indices[-1][0] != "":
-                words_indices += self._get_next_words(text, words_indices[-1][1], 1)
-        return words_indices
-
     def _hide_swear_words(self, text, censor_char):
         """Replace the swear words with censor characters."""
-        censored_text = ""
-        cur_word = ""
-        skip_index = -1
-        next_words_indices = []
-        start_idx_of_next_word = self._get_start_index_of_next_word(text, 0)
+        words = self._get_words(text)
 
         # If there are no words in the text, return the raw text without parsing
-        if start_idx_of_next_word >= len(text) - 1:
+        if not words or words[0][0] >= len(text) - 1:
             return text
 
-        # Left strip the text, to avoid inaccurate parsing
-        if start_idx_of_next_word > 0:
-            censored_text = text[:start_idx_of_next_word]
-            text = text[start_idx_of_next_word:]
+        censored_text = [text[:words[0][0]]]
+        index = 0
+        while index < len(words):
+            start_idx, end_idx = words[index]
+            cur_word = text[start_idx:end_idx]
 
-        # Splitting each word in the text to compare with censored words
-        for index, char in iter(enumerate(text)):
-            if index < skip_index:
-                continue
-            if char in ALLOWED_CHARACTERS:
-                cur_word += char
-                continue
+            # The final word has no next words, but may have profanity within it
+            if end_idx == len(text):
+                if cur_word.lower() in self.CENSOR_WORDSET:
+                    cur_word = get_replacement_for_swear_word(censor_char)
 
-            # Skip continuous non-allowed characters
-            if cur_word.strip() == "":
-                censored_text += char
-                cur_word = ""
-                continue
+                # Check if removeing letters from behind makes a swear word
+                cur_word = self._check_for_profanity_within(cur_word, censor_char, [])
+                censored_text.append(cur_word)
+                break
 
-            
-            # Iterate the next words combined with the current one
+            # Check the next words combined with the current one
             # to check if it forms a swear word
-            next_words_indices = self._update_next_words_indices(
-                text, next_words_indices, index
-            )
-
-
-          
-            contains_swear_word, end_index = any_next_words_form_swear_word(
-                cur_word, next_words_indices, self.CENSOR_WORDSET
-            )
-            if contains_swear_word:
-                cur_word = get_replacement_for_swear_word(censor_char)
-                skip_index = end_index
-                char = ""
-                next_words_indices = []
-
-            # If the current a swear word
-            if cur_word.lower() in self.CENSOR_WORDSET:
-                cur_word = get_replacement_for_swear_word(censor_char)
-
-            
-          
-            censored_text += cur_word + char
-            cur_word = ""
-            
-
-
-                  
-        # Final check
-        if cur_word != "" and skip_index < len(text) - 1:
-            if cur_word.lower() in self.CENSOR_WORDSET:
-                cur_word = get_replacement_for_swear_word(censor_char)
-
-                      
-            # Check if removeing letters from behind makes a swear word
-            cur_word = self._check_for_profanity_within(cur_word, censor_char, [])
-            censored_text += cur_word
-          
-        return censored_text
+            num_of_next_words = self._next_words_form_swear_word(text, words, index)
+            if num_of_next_words:
+                censored_text.append(get_replacement_for_swear_word(censor_char))
+                index += num_of_next_words
+
+                # A swear word running to the end of the text swallows its last character
+                if words[index][1] == len(text):
+                    break
+            else:
+                # If the current a swear word
+                if cur_word.lower() in self.CENSOR_WORDSET:
+                    cur_word = get_replacement_for_swear_word(censor_char)
+                censored_text.append(cur_word)
+
+            # Keep the separators up to the next word
+            index += 1
+            if index < len(words):
+                censored_text.append(text[words[index - 1][1]:words[index][0]])
+            else:
+                censored_text.append(text[words[index - 1][1]:])
+
+        return "".join(censored_text)
 
     def _check_for_profanity_within(self, cur_word, censor_char, next_words_indices):
       """Checks if there is profanity within """
@@ -249,53 +270,47 @@ class Profanity:
       
       return cur_word
   
-    def _get_start_index_of_next_word(self, text, start_idx):
-        """Return the index of the first character of the next word in the given text."""
-        start_idx_of_next_word = len(text)
-        for index in iter(range(start_idx, len(text))):
-            if text[index] not in self.ALLOWED_CHARACTERS:
-                continue
-            start_idx_of_next_word = index
-            break
 
-        return start_idx_of_next_word
-
-    def _get_next_word_and_end_index(self, text, start_idx):
-        """Return the next word in the given text, and the index of its last character."""
-        next_word = ""
-        index = start_idx
-        for index in iter(range(start_idx, len(text))):
-            char = text[index]
+    def _get_words(self, text):
+        """Return the start and end indices of every word in the given text."""
+        words = []
+        start_idx = -1
+        for index, char in enumerate(text):
             if char in self.ALLOWED_CHARACTERS:
-                next_word += char
-                continue
-            break
-        return next_word, index
+                if start_idx == -1:
+                    start_idx = index
+            elif start_idx != -1:
+                words.append((start_idx, index))
+                start_idx = -1
+        if start_idx != -1:
+            words.append((start_idx, len(text)))
+        return words
 
-    def _get_next_words(self, text, start_idx, num_of_next_words=1):
+    def _next_words_form_swear_word(self, text, words, index):
         """
-        Return a list of pairs of next words and next words included with separators,
-        combined with their end indices.
-        For example: Word `hand_job` has next words pairs: `job`, `_job`.
+        Return how many of the words after `words[index]` form a swear word
+        when combined with it, or 0 if they don't.
+        For example: Word `hand_job` is formed by `hand` and `job` or `_job`.
         """
-
-        # Find the starting index of the next word
-        start_idx_of_next_word = self._get_start_index_of_next_word(text, start_idx)
-
-        # Return an empty string if there are no other words
-        if start_idx_of_next_word >= len(text) - 1:
-            return [("", start_idx_of_next_word), ("", start_idx_of_next_word)]
-
-        # Combine the  words into a list
-        next_word, end_index = self._get_next_word_and_end_index(
-            text, start_idx_of_next_word
-        )
-
-        words = [
-            (next_word, end_index),
-            ("%s%s" % (text[start_idx:start_idx_of_next_word], next_word), end_index),
-        ]
-        if num_of_next_words > 1:
-            words.extend(self._get_next_words(text, end_index, num_of_next_words - 1))
-
-        return words
+        full_word = text[words[index][0]:words[index][1]].lower()
+        full_word_with_separators = full_word
+        prev_end_idx = words[index][1]
+
+        next_words = words[index + 1:index + 1 + self.MAX_NUMBER_COMBINATIONS]
+        for num_of_next_words, (start_idx, end_idx) in enumerate(next_words, 1):
+            # A single character at the very end of the text doesn't count as a next word
+            if start_idx >= len(text) - 1:
+                break
+
+            full_word = "%s%s" % (full_word, text[start_idx:end_idx].lower())
+            full_word_with_separators = "%s%s" % (
+                full_word_with_separators,
+                text[prev_end_idx:end_idx].lower(),
+            )
+            if (
+                full_word in self.CENSOR_WORDSET
+                or full_word_with_separators in self.CENSOR_WORDSET
+            ):
+                return num_of_next_words
+            prev_end_idx = end_idx
+        return 0
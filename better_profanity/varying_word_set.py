@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# Key marking the end of a word in a trie node.
+_END = None
+
+
+class VaryingWordSet:
+    """Represents a set of strings with varying character representations.
+
+    Equivalent to a list of `VaryingString` objects, but the words are compiled
+    into a trie so that membership is answered in O(word length) instead of
+    comparing against every word.
+    """
+
+    def __init__(self, words=(), char_map={}):
+        """
+        Args:
+            words (Iterable): Words to add to the set.
+            char_map (dict): Maps characters to substitute characters. Every
+                substitute must be a single character.
+        """
+        self._root = {}
+        self._words = set()
+
+        # Reverse the character map, so that each character of a string knows
+        # which characters of a word it could be standing in for.
+        self._sources = {}
+        for char, substitutes in char_map.items():
+            for substitute in substitutes:
+                if len(substitute) != 1:
+                    raise ValueError(
+                        "Substitutes in 'char_map' must be single characters, "
+                        "but '{sub}' found.".format(sub=substitute)
+                    )
+                self._sources.setdefault(substitute, []).append(char)
+        for substitute, sources in self._sources.items():
+            if substitute not in char_map:
+                sources.append(substitute)
+        for char in char_map:
+            self._sources.setdefault(char, [])
+
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len(self._words)
+
+    def __iter__(self):
+        return iter(self._words)
+
+    def __contains__(self, string):
+        if string.__class__ != str:
+            return False
+        nodes = [self._root]
+        for char in string:
+            sources = self._sources.get(char, (char,))
+            next_nodes = []
+            for node in nodes:
+                for source in sources:
+                    child = node.get(source)
+                    if child is not None:
+                        next_nodes.append(child)
+            if not next_nodes:
+                return False
+            nodes = next_nodes
+        for node in nodes:
+            if _END in node:
+                return True
+        return False
+
+    def add(self, word):
+        """Add a word to the set."""
+        node = self._root
+        for char in word:
+            node = node.setdefault(char, {})
+        node[_END] = True
+        self._words.add(word)
@@ -11,8 +11,16 @@ Please see https://github.com/MikeDev101/cloudlink for more details.
 """
 
 import json
+import struct
 import sys
 import threading
+import asyncio
+import base64
+import hashlib
+import ipaddress
+import queue
+import heapq
+import itertools
 from websocket_server import WebsocketServer as ws_server
 import websocket as ws_client
 import time
@@ -46,17 +54,403 @@ def full_stack():
         stackstr += '  ' + traceback.format_exc().lstrip(trc)
     return stackstr
 
+class IPBlocklist: # Blocked IP addresses and CIDR ranges (or IPv4 wildcards like 10.0.*), looked up by hash instead of scanning a list
+    min_prefixlen = {4: 8, 6: 16} # Wider ranges than these (e.g. a stray "*") are kept as plain strings, so they can't block everyone
+    
+    def __init__(self, entries=[]):
+        self.entries = {} # Every entry as it was given, in the order it was added
+        self.addresses = set() # Single addresses, and entries that aren't IPs at all
+        self.networks = {} # (IP version, prefix length): set of network prefixes
+        for entry in entries:
+            self.add(entry)
+    
+    def __contains__(self, ip):
+        if ip in self.addresses:
+            return True
+        if len(self.networks) == 0:
+            return False
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        for (version, prefixlen), prefixes in self.networks.items():
+            if (version == address.version) and ((int(address) >> (address.max_prefixlen - prefixlen)) in prefixes):
+                return True
+        return False
+    
+    def __iter__(self):
+        return iter(list(self.entries))
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def add(self, entry): # Adds an entry, returns False if it was already blocked
+        if entry in self.entries:
+            return False
+        network = self.parse_network(entry)
+        if network == None:
+            self.addresses.add(entry)
+        else:
+            key = (network.version, network.prefixlen)
+            if not key in self.networks:
+                self.networks[key] = set()
+            self.networks[key].add(int(network.network_address) >> (network.max_prefixlen - network.prefixlen))
+        self.entries[entry] = network
+        return True
+    
+    def remove(self, entry): # Removes an entry, returns False if it wasn't blocked
+        if not entry in self.entries:
+            return False
+        network = self.entries.pop(entry)
+        if network == None:
+            self.addresses.discard(entry)
+        else:
+            # Another entry may spell the same range differently, keep the prefix if so
+            if not network in self.entries.values():
+                key = (network.version, network.prefixlen)
+                self.networks[key].discard(int(network.network_address) >> (network.max_prefixlen - network.prefixlen))
+                if len(self.networks[key]) == 0:
+                    del self.networks[key]
+        return True
+    
+    @classmethod
+    def parse_network(cls, entry): # Returns the range an entry covers, or None for single addresses, ranges that are too wide and other strings
+        if (not type(entry) == str) or ((not "/" in entry) and (not "*" in entry)):
+            return None
+        if "*" in entry:
+            # IPv4 wildcard, 10.0.* or 10.0.*.* becomes 10.0.0.0/16
+            octets = entry.split(".")
+            while (len(octets) > 0) and (octets[-1] == "*"):
+                octets.pop()
+            if (len(octets) > 3) or ("*" in octets):
+                return None
+            entry = "{0}/{1}".format(".".join(octets + (["0"] * (4 - len(octets)))), 8 * len(octets))
+        try:
+            network = ipaddress.ip_network(entry, strict=False)
+        except ValueError:
+            return None
+        if network.prefixlen < cls.min_prefixlen[network.version]:
+            return None
+        return network
+
+class WorkerPool: # Bounded pool of worker threads. Tasks with the same key always run in order, on the same worker.
+    def __init__(self, workers=8, max_queue_depth=100, debug=False):
+        self.debug = debug
+        self.max_queue_depth = max_queue_depth # Per-worker limit on queued tasks before new ones are rejected
+        self.queues = []
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "processed": 0,
+            "rejected": 0,
+            "total_wait": 0.0,
+            "max_wait": 0.0
+        }
+        self.delayed = [] # Heap of tasks waiting for their delay to pass
+        self.delayed_order = itertools.count()
+        self.delayed_cond = threading.Condition()
+        
+        for i in range(workers):
+            tasks = queue.Queue()
+            self.queues.append(tasks)
+            threading.Thread(target=self._worker, args=(tasks,), daemon=True).start()
+        threading.Thread(target=self._scheduler, daemon=True).start()
+    
+    def submit(self, key, function, *args, force=False): # Queues a task, returns False if the key's worker is too backed up to take it
+        tasks = self.queues[hash(key) % len(self.queues)]
+        if (not force) and (tasks.qsize() >= self.max_queue_depth):
+            with self.stats_lock:
+                self.stats["rejected"] += 1
+            if self.debug:
+                print("Worker queue full, rejecting task for {0}".format(key))
+            return False
+        tasks.put((time.perf_counter(), function, args))
+        return True
+    
+    def submit_later(self, delay, key, function, *args): # Queues a task once delay (in seconds) has passed
+        with self.delayed_cond:
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.delayed_order), key, function, args))
+            self.delayed_cond.notify()
+    
+    def get_stats(self): # Returns task counts and queue wait times
+        with self.stats_lock:
+            stats = self.stats.copy()
+        stats["queued"] = sum(tasks.qsize() for tasks in self.queues)
+        if stats["processed"] > 0:
+            stats["avg_wait_ms"] = (stats["total_wait"] / stats["processed"]) * 1000
+        else:
+            stats["avg_wait_ms"] = 0.0
+        stats["max_wait_ms"] = stats["max_wait"] * 1000
+        del stats["total_wait"]
+        del stats["max_wait"]
+        return stats
+    
+    def _scheduler(self):
+        while True:
+            with self.delayed_cond:
+                while (len(self.delayed) == 0) or (self.delayed[0][0] > time.monotonic()):
+                    if len(self.delayed) == 0:
+                        self.delayed_cond.wait()
+                    else:
+                        self.delayed_cond.wait(self.delayed[0][0] - time.monotonic())
+                run_at, order, key, function, args = heapq.heappop(self.delayed)
+            self.submit(key, function, *args, force=True)
+    
+    def _worker(self, tasks):
+        while True:
+            queued_at, function, args = tasks.get()
+            wait = time.perf_counter() - queued_at
+            with self.stats_lock:
+                self.stats["processed"] += 1
+                self.stats["total_wait"] += wait
+                if wait > self.stats["max_wait"]:
+                    self.stats["max_wait"] = wait
+            try:
+                function(*args)
+            except Exception as e:
+                if self.debug:
+                    print("Error on worker: {0}".format(full_stack()))
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11" # Magic string for the handshake, from RFC 6455
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+def encode_frame(payload, opcode=OPCODE_TEXT): # Encodes a single unmasked WebSocket frame, servers never mask their frames
+    header = bytearray([0x80 | opcode]) # FIN + opcode
+    if len(payload) <= 125:
+        header.append(len(payload))
+    elif len(payload) <= 65535:
+        header.append(126)
+        header.extend(struct.pack(">H", len(payload)))
+    else:
+        header.append(127)
+        header.extend(struct.pack(">Q", len(payload)))
+    return bytes(header) + payload
+
+def unmask_payload(payload, mask): # XORs a client frame's payload with its masking key
+    if len(payload) == 0:
+        return payload
+    key = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(len(payload), "big")
+
+class AsyncClientHandler: # Per-connection state for AsyncWebsocketServer, stands in for websocket_server's handler
+    def __init__(self, server, writer):
+        self.server = server
+        self.writer = writer
+        self.closed = False
+    
+    def send_message(self, message): # Sends a text message, safe to call from any thread
+        self.send_frame(encode_frame(message.encode("utf-8")))
+    
+    def send_frame(self, frame): # Sends a pre-encoded frame, safe to call from any thread
+        if threading.get_ident() == self.server.loop_thread:
+            self._write(frame)
+        else:
+            self.server.loop.call_soon_threadsafe(self._write, frame)
+    
+    def send_close(self, status=1000, reason=b""): # Sends a close frame and drops the connection, safe to call from any thread
+        if threading.get_ident() == self.server.loop_thread:
+            self._close(status, reason)
+        else:
+            self.server.loop.call_soon_threadsafe(self._close, status, reason)
+    
+    def _write(self, frame):
+        if self.closed:
+            return
+        self.writer.write(frame)
+        if self.writer.transport.get_write_buffer_size() > self.server.max_write_buffer:
+            # The client isn't reading what it's sent, drop it rather than buffering forever
+            if self.server.debug:
+                print("Dropping slow client: write buffer over {0} bytes".format(self.server.max_write_buffer))
+            self._close(1008, b"")
+    
+    def _close(self, status, reason):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.writer.write(encode_frame(struct.pack(">H", status) + reason, OPCODE_CLOSE))
+        except Exception as e:
+            pass
+        self.writer.close()
+
+class AsyncWebsocketServer: # asyncio WebSocket server with the same interface CloudLink uses from websocket_server, all connections share one event loop
+    def __init__(self, host="127.0.0.1", port=3000, debug=False, max_message_size=1048576, max_write_buffer=1048576, handshake_timeout=10):
+        self.host = host
+        self.port = port
+        self.debug = debug
+        self.max_message_size = max_message_size # Connections sending bigger messages than this are dropped
+        self.max_write_buffer = max_write_buffer # Connections with more unsent data than this are dropped
+        self.handshake_timeout = handshake_timeout
+        self.clients = []
+        self.id_counter = 0
+        self.loop = None
+        self.loop_thread = None
+        self.server = None
+        self.fn_new_client = lambda client, server: None
+        self.fn_client_left = lambda client, server: None
+        self.fn_message_received = lambda client, server, message: None
+    
+    def set_fn_new_client(self, fn):
+        self.fn_new_client = fn
+    
+    def set_fn_client_left(self, fn):
+        self.fn_client_left = fn
+    
+    def set_fn_message_received(self, fn):
+        self.fn_message_received = fn
+    
+    def send_message(self, client, message):
+        client["handler"].send_message(message)
+    
+    def send_frame(self, client, frame):
+        client["handler"].send_frame(frame)
+    
+    def run_forever(self, threaded=False):
+        if threaded:
+            threading.Thread(target=self._run, daemon=True).start()
+        else:
+            self._run()
+    
+    def shutdown_gracefully(self, status=1000, reason=b""):
+        for client in list(self.clients):
+            client["handler"].send_close(status, reason)
+        self.loop.call_soon_threadsafe(self._stop)
+    
+    def shutdown_abruptly(self):
+        for client in list(self.clients):
+            self.loop.call_soon_threadsafe(client["handler"].writer.close)
+        self.loop.call_soon_threadsafe(self._stop)
+    
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.get_ident()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self._handle_connection, self.host, self.port, backlog=1024))
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+    
+    def _stop(self):
+        self.server.close()
+        self.loop.stop()
+    
+    async def _handshake(self, reader, writer): # Performs the HTTP upgrade, returns False if the request isn't a WebSocket handshake
+        request = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        headers = {}
+        for line in request[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        if (not request[0].startswith("GET ")) or (headers.get("upgrade", "").lower() != "websocket") or (not "sec-websocket-key" in headers):
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n")
+            return False
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WS_GUID).encode("latin-1")).digest()).decode("latin-1")
+        writer.write((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Accept: {0}\r\n\r\n"
+        ).format(accept).encode("latin-1"))
+        return True
+    
+    async def _read_frame(self, reader): # Returns (fin, opcode, payload) for the next frame
+        head = await reader.readexactly(2)
+        fin = bool(head[0] & 0x80)
+        opcode = head[0] & 0x0F
+        length = head[1] & 0x7F
+        if not head[1] & 0x80:
+            raise ValueError("Client frames must be masked")
+        if length == 126:
+            length = struct.unpack(">H", await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", await reader.readexactly(8))[0]
+        if length > self.max_message_size:
+            raise ValueError("Frame too large")
+        mask = await reader.readexactly(4)
+        return fin, opcode, unmask_payload(await reader.readexactly(length), mask)
+    
+    async def _handle_connection(self, reader, writer):
+        try:
+            upgraded = await asyncio.wait_for(self._handshake(reader, writer), self.handshake_timeout)
+        except Exception as e:
+            upgraded = False
+        if not upgraded:
+            writer.close()
+            return
+        
+        self.id_counter += 1
+        client = {
+            "id": self.id_counter,
+            "handler": AsyncClientHandler(self, writer),
+            "address": writer.get_extra_info("peername")
+        }
+        self.clients.append(client)
+        try:
+            self.fn_new_client(client, self)
+            fragments = []
+            fragments_size = 0
+            fragmented_opcode = None
+            while not client["handler"].closed:
+                fin, opcode, payload = await self._read_frame(reader)
+                if opcode == OPCODE_CLOSE:
+                    if len(payload) >= 2:
+                        client["handler"]._close(struct.unpack(">H", payload[:2])[0], b"")
+                    else:
+                        client["handler"]._close(1000, b"")
+                elif opcode == OPCODE_PING:
+                    client["handler"]._write(encode_frame(payload, OPCODE_PONG))
+                elif opcode == OPCODE_PONG:
+                    pass
+                else:
+                    if opcode != OPCODE_CONTINUATION:
+                        fragmented_opcode = opcode
+                        fragments = []
+                        fragments_size = 0
+                    fragments.append(payload)
+                    fragments_size += len(payload)
+                    if fragments_size > self.max_message_size:
+                        raise ValueError("Message too large")
+                    if fin:
+                        # Binary messages aren't supported by CloudLink, same as websocket_server
+                        if fragmented_opcode == OPCODE_TEXT:
+                            self.fn_message_received(client, self, b"".join(fragments).decode("utf-8"))
+                        fragments = []
+                        fragments_size = 0
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            pass
+        except Exception as e:
+            if self.debug:
+                print("Error on AsyncWebsocketServer: {0}".format(full_stack()))
+        finally:
+            client["handler"].closed = True
+            writer.close()
+            self.clients.remove(client)
+            self.fn_client_left(client, self)
+
 class API:
-    def server(self, ip="127.0.0.1", port=3000, threaded=False): # Runs CloudLink in server mode.
+    def server(self, ip="127.0.0.1", port=3000, threaded=False, use_asyncio=False): # Runs CloudLink in server mode, use_asyncio serves every connection from one event loop instead of a thread each.
         try:
             if self.state == 0:
                 
                 # Change the link state to 1 (Server mode)
                 self.state = 1
-                self.wss = ws_server(
-                    host=ip,
-                    port=port
-                )
+                self.use_asyncio = use_asyncio
+                if use_asyncio:
+                    self.wss = AsyncWebsocketServer(
+                        host=ip,
+                        port=port,
+                        debug=self.debug
+                    )
+                else:
+                    self.wss = ws_server(
+                        host=ip,
+                        port=port
+                    )
                 
                 # Set the server's callbacks to CloudLink's class functions
                 self.wss.set_fn_new_client(self._on_connection_server)
@@ -72,12 +466,14 @@ class API:
                     self.statedata["secure_enable"] = False
                     self.statedata["secure_keys"] = []
                 if not "ip_blocklist" in self.statedata:
-                    self.statedata["ip_blocklist"] = [""]
+                    self.statedata["ip_blocklist"] = IPBlocklist([""])
                 
                 self.statedata = {
                     "ulist": {
                         "usernames": {},
-                        "objs": {}
+                        "objs": {},
+                        "visible": {}, # Usernames shown in the ulist, in the order they joined
+                        "cache": "" # Semicolon-joined visible usernames, None when it needs rebuilding
                     }, # Username list for the "Usernames" block
                     "secure_enable": False, # Trusted Access enabler
                     "secure_keys": [], # Trusted Access keys
@@ -86,7 +482,7 @@ class API:
                     "motd": self.statedata["motd"], # MOTD text
                     "secure_enable": self.statedata["secure_enable"], # Trusted Access enabler
                     "secure_keys": self.statedata["secure_keys"], # Trusted Access keys
-                    "trusted": [], # Clients that are trusted with Secure Access, references memory objects only
+                    "trusted": {}, # Clients that are trusted with Secure Access, keyed by client ID
                     "ip_blocklist": self.statedata["ip_blocklist"] # Blocks clients with certain IP addresses
                 }
                 
@@ -281,8 +677,8 @@ class API:
         if self.state == 1:
             if self.statedata["secure_enable"]:
                 if type(obj) == dict:
-                    if obj in self.statedata["trusted"]:
-                        self.statedata["trusted"].remove(obj)
+                    if obj["id"] in self.statedata["trusted"]:
+                        del self.statedata["trusted"][obj["id"]]
                         if self.debug:
                             print("Untrusted ID {0}.".format(obj["id"]))
                     else:   
@@ -291,8 +687,8 @@ class API:
                 elif type(obj) == str:
                     obj = self._get_obj_of_username(obj)
                     if not obj == None:
-                        if obj in self.statedata["trusted"]:
-                            self.statedata["trusted"].remove(obj)
+                        if obj["id"] in self.statedata["trusted"]:
+                            del self.statedata["trusted"][obj["id"]]
                             if self.debug:
                                 print("Untrusted ID {0}.".format(obj["id"]))
                         else:   
@@ -308,11 +704,9 @@ class API:
             if self.debug:
                 print("Error: Cannot use the untrust function in current state!")
     
-    def loadIPBlocklist(self, blist): # Loads a list of IP addresses to block
+    def loadIPBlocklist(self, blist): # Loads a list of IP addresses and CIDR ranges to block
         if type(blist) == list:
-            if not '' in blist:
-                blist.append("")
-            self.statedata["ip_blocklist"] = blist
+            self.statedata["ip_blocklist"] = IPBlocklist(blist + [""])
             if self.debug:
                 print("Loaded {0} blocked IPs into the blocklist!".format(len(self.statedata["ip_blocklist"])-1))
     
@@ -320,8 +714,7 @@ class API:
         if self.state == 1:
             if self.statedata["secure_enable"]:
                 if type(ip) == str:
-                    if not ip in self.statedata["ip_blocklist"]:
-                        self.statedata["ip_blocklist"].append(ip)
+                    if self.statedata["ip_blocklist"].add(ip):
                         if self.debug:
                             print("Blocked IP {0}!".format(ip))
         else:
@@ -332,8 +725,7 @@ class API:
         if self.state == 1:
             if self.statedata["secure_enable"]:
                 if type(ip) == str:
-                    if ip in self.statedata["ip_blocklist"]:
-                        self.statedata["ip_blocklist"].remove(ip)
+                    if self.statedata["ip_blocklist"].remove(ip):
                         if self.debug:
                             print("Unblocked IP {0}!".format(ip))
         else:
@@ -343,14 +735,21 @@ class API:
     def getIPBlocklist(self): # Returns the latest IP blocklist
         if self.state == 1:
             if self.statedata["secure_enable"]:
-                tmp = self.statedata["ip_blocklist"]
-                tmp.remove('')
-                return self.statedata["ip_blocklist"]
+                return [ip for ip in self.statedata["ip_blocklist"] if not ip == ""]
         else:
             if self.debug:
                 print("Error: Cannot use the IP Blocklist get function in current state!")
             return []
     
+    def getWorkerStats(self): # Returns packet worker pool stats (processed, rejected, queued and queue wait times)
+        return self.workers.get_stats()
+    
+    def getUlistStats(self): # Returns how many ulist updates were made, how many broadcasts they were sent in and how many broadcasts that saved
+        with self.ulist_lock:
+            stats = self.ulist_stats.copy()
+        stats["saved"] = stats["updates"] - stats["broadcasts"]
+        return stats
+    
     def kickClient(self, obj): # Terminates a client's connection (should only be used for specific purposes)
         if self.state == 1:
             if self.statedata["secure_enable"]:
@@ -391,8 +790,9 @@ class CLTLS: #Feature NOT YET IMPLEMENTED
 """
 
 class CloudLink(API):
-    def __init__(self, debug=False): # Initializes CloudLink
+    def __init__(self, debug=False, workers=8, max_queue_depth=100, ulist_window=0.25): # Initializes CloudLink
         self.wss = None # Websocket Object
+        self.use_asyncio = False # Whether the server runs on AsyncWebsocketServer
         self.state = 0 # Module state
         self.userlist = [] # Stores usernames set on link
         self.callback_function = { # For linking external code, use with functions
@@ -402,6 +802,15 @@ class CloudLink(API):
             "on_close": None # Runs code when disconnected (client) or server stops (server)
         }
         self.debug = debug # Print back specific data
+        self.workers = WorkerPool(workers=workers, max_queue_depth=max_queue_depth, debug=debug) # Runs packets and callbacks, in order per client
+        self.ulist_lock = threading.Lock() # Guards the ulist and its cached string
+        self.ulist_window = ulist_window # Seconds to collect ulist updates for before broadcasting them together, 0 to broadcast each one immediately
+        self.ulist_pending = {} # Usernames updated in the current window, and whether they were visible before it
+        self.ulist_flush_scheduled = False
+        self.ulist_stats = {
+            "updates": 0,
+            "broadcasts": 0
+        }
         self.statedata = {} # Place to store other garbage for modes
         self.codes = { # Current set of CloudLink status/error self.codes
             "Test": "I:000 | Test", # Test code
@@ -470,7 +879,7 @@ class CloudLink(API):
     
     def _is_obj_trusted(self, obj): # Checks if a client is trusted on the link
         if self.statedata["secure_enable"]:
-            return ((obj in self.statedata["trusted"]) and (not self._is_obj_blocked(obj)))
+            return ((obj["id"] in self.statedata["trusted"]) and (not self._is_obj_blocked(obj)))
         else:
             return False
     
@@ -480,26 +889,48 @@ class CloudLink(API):
         else:
             return False
     
-    def _send_to_all(self, payload): # "Better" (?) send to all function
-        tmp_payload = payload
-        for client in self.wss.clients:
-            #print("sending {0} to {1}".format(payload, client["id"]))
-            if self._get_client_type(client) == "scratch":
-                #print("sending to all, {0} is a scratcher".format(client["id"]))
-                if ("val" in payload) and (type(payload["val"]) == dict):
-                    #print("stringifying nested json")
-                    tmp_payload["val"] = json.dumps(payload["val"])
-                if not self.statedata["secure_enable"]:
-                    self.wss.send_message(client, json.dumps(tmp_payload))
-                else:
-                    if self._is_obj_trusted(client):
-                        self.wss.send_message(client, json.dumps(tmp_payload))
-            else:
-                if not self.statedata["secure_enable"]:
-                    self.wss.send_message(client, json.dumps(payload))
+    def _encode_frame(self, message): # Encodes a text message as a WebSocket frame, so it can be sent to many clients as-is
+        return encode_frame(message.encode("utf-8"))
+    
+    def _send_frame(self, client, frame): # Sends a pre-encoded frame to a client
+        if self.use_asyncio:
+            self.wss.send_frame(client, frame)
+        else:
+            # websocket_server's handler sends under this lock, without it the frame could land in the middle of another message
+            with client["handler"]._send_lock:
+                client["handler"].request.sendall(frame)
+    
+    def _send_to_all(self, payload, delta_payloads=None): # Sends to all clients, serializing the payload only once per client type. Clients that opted into ulist deltas get delta_payloads instead, if given.
+        start = time.perf_counter()
+        frames = {} # Encoded frames, keyed by whether the client is a Scratch client and whether it gets the delta
+        recipients = 0
+        for client in list(self.wss.clients):
+            if self.statedata["secure_enable"]:
+                if (not client["id"] in self.statedata["trusted"]) or self._is_obj_blocked(client):
+                    continue
+            is_scratch = (self._get_client_type(client) == "scratch")
+            use_delta = (not delta_payloads == None) and self._wants_ulist_delta(client)
+            if not (is_scratch, use_delta) in frames:
+                if use_delta:
+                    tmp_payloads = delta_payloads
                 else:
-                    if self._is_obj_trusted(client):
-                        self.wss.send_message(client, json.dumps(payload))
+                    tmp_payloads = [payload]
+                frames[(is_scratch, use_delta)] = []
+                for tmp_payload in tmp_payloads:
+                    if is_scratch and ("val" in tmp_payload) and (type(tmp_payload["val"]) == dict):
+                        # Scratch clients need nested JSON stringified
+                        tmp_payload = tmp_payload.copy()
+                        tmp_payload["val"] = json.dumps(tmp_payload["val"])
+                    frames[(is_scratch, use_delta)].append(self._encode_frame(json.dumps(tmp_payload)))
+            try:
+                for frame in frames[(is_scratch, use_delta)]:
+                    self._send_frame(client, frame)
+                recipients += 1
+            except Exception as e:
+                if self.debug:
+                    print("Error on _send_to_all: Failed to send to {0}: {1}".format(client["id"], e))
+        if self.debug:
+            print("Sent broadcast to {0} clients in {1:.2f}ms".format(recipients, (time.perf_counter() - start) * 1000))
     
     def _server_packet_handler(self, client, server, message, listener_detected=False, listener_id=""): # The almighty packet handler, single-handedly responsible for over hundreds of lines of code
         if not type(client) == type(None):
@@ -632,16 +1063,15 @@ class CloudLink(API):
                                                     if type(msg["val"]) == str:
                                                         if self.statedata["ulist"]["objs"][client['id']]["username"] == "":
                                                             if not msg["val"] in self.statedata["ulist"]["usernames"]:
-                                                                # Add the username to the list
-                                                                self.statedata["ulist"]["usernames"][msg["val"]] = client["id"]
-                                                                # Set the object's username info
-                                                                self.statedata["ulist"]["objs"][client['id']]["username"] = msg["val"]
+                                                                # Add the username to the list and set the object's username info
+                                                                changed = self._add_username(client, msg["val"])
                                                                 
                                                                 if listener_detected:
                                                                     self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"], "listener": listener_id}))
                                                                 else:
                                                                     self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["OK"]}))
-                                                                self._send_to_all({"cmd": "ulist", "val": self._get_ulist()})
+                                                                if changed:
+                                                                    self._send_ulist_update("ulist_add", msg["val"])
                                                                 if self.debug:
                                                                     print("User {0} set username: {1}".format(client["id"], msg["val"]))
                                                             else:
@@ -722,6 +1152,11 @@ class CloudLink(API):
                                                             self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"], "listener": listener_id}))
                                                         else:
                                                             self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["Syntax"]}))
+                                                elif msg["val"]["cmd"] == "ulist_delta":
+                                                    # Client wants ulist_add/ulist_remove messages instead of the full ulist on every change
+                                                    self.statedata["ulist"]["objs"][client["id"]]["ulist_delta"] = (("val" in msg["val"]) and (msg["val"]["val"] == True))
+                                                    if self.debug:
+                                                        print("Client {0} set ulist deltas to {1}".format(client["id"], self.statedata["ulist"]["objs"][client["id"]]["ulist_delta"]))
                                                 elif msg["val"]["cmd"] == "ip":
                                                     try:
                                                         if "val" in msg["val"]:
@@ -993,16 +1428,72 @@ class CloudLink(API):
                 else:
                     self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["EmptyPacket"]}))
     
-    def _get_ulist(self): # Generates username list
-        tmp_ulist = list((self.statedata["ulist"]["usernames"]).keys())
-        for item in tmp_ulist:
-            if item[0] == "%" and item[len(item)-1] == "%":
-                tmp_ulist.pop(tmp_ulist.index(item))
-        
-        output = ""
-        for item in tmp_ulist:
-            output = output + item + ";"
-        return output
+    def _is_hidden_username(self, username): # Usernames wrapped in % are kept out of the ulist
+        return (len(username) > 0) and (username[0] == "%") and (username[len(username)-1] == "%")
+    
+    def _wants_ulist_delta(self, client): # Checks if a client opted into ulist_add/ulist_remove messages
+        obj = self.statedata["ulist"]["objs"].get(client["id"])
+        return (not obj == None) and obj.get("ulist_delta", False)
+    
+    def _add_username(self, client, username): # Sets a client's username and adds it to the ulist, returns True if the visible ulist changed
+        with self.ulist_lock:
+            if not client["id"] in self.statedata["ulist"]["objs"]:
+                return False
+            self.statedata["ulist"]["usernames"][username] = client["id"]
+            self.statedata["ulist"]["objs"][client["id"]]["username"] = username
+            if self._is_hidden_username(username) or (username in self.statedata["ulist"]["visible"]):
+                return False
+            self.statedata["ulist"]["visible"][username] = None
+            if not self.statedata["ulist"]["cache"] == None:
+                self.statedata["ulist"]["cache"] += username + ";"
+            return True
+    
+    def _remove_username(self, username): # Removes a username from the ulist, returns True if the visible ulist changed
+        with self.ulist_lock:
+            if username in self.statedata["ulist"]["usernames"]:
+                del self.statedata["ulist"]["usernames"][username]
+            if not username in self.statedata["ulist"]["visible"]:
+                return False
+            del self.statedata["ulist"]["visible"][username]
+            self.statedata["ulist"]["cache"] = None
+            return True
+    
+    def _get_ulist(self): # Returns the username list, only rebuilding it after a username was removed
+        with self.ulist_lock:
+            if self.statedata["ulist"]["cache"] == None:
+                self.statedata["ulist"]["cache"] = "".join(username + ";" for username in self.statedata["ulist"]["visible"])
+            return self.statedata["ulist"]["cache"]
+    
+    def _send_ulist_update(self, cmd, username): # Queues a ulist broadcast for a username that was added or removed (cmd is ulist_add/ulist_remove), updates within ulist_window are sent as one broadcast
+        with self.ulist_lock:
+            self.ulist_stats["updates"] += 1
+            if not username in self.ulist_pending:
+                # Remember whether the username was visible before this window, so only the net change is sent
+                self.ulist_pending[username] = (cmd == "ulist_remove")
+            if self.ulist_flush_scheduled:
+                return
+            self.ulist_flush_scheduled = True
+        if self.ulist_window > 0:
+            self.workers.submit_later(self.ulist_window, "ulist", self._flush_ulist_updates)
+        else:
+            self._flush_ulist_updates()
+    
+    def _flush_ulist_updates(self): # Broadcasts the latest ulist, clients that opted into deltas get the net ulist_add/ulist_remove messages instead
+        with self.ulist_lock:
+            pending = self.ulist_pending
+            self.ulist_pending = {}
+            self.ulist_flush_scheduled = False
+            deltas = []
+            for username, was_visible in pending.items():
+                is_visible = (username in self.statedata["ulist"]["visible"])
+                if is_visible and (not was_visible):
+                    deltas.append({"cmd": "ulist_add", "val": username})
+                elif was_visible and (not is_visible):
+                    deltas.append({"cmd": "ulist_remove", "val": username})
+            if len(deltas) == 0:
+                return
+            self.ulist_stats["broadcasts"] += 1
+        self._send_to_all({"cmd": "ulist", "val": self._get_ulist()}, deltas)
     
     def _on_connection_server(self, client, server): # Server-side new connection handler
         if not type(client) == type(None):
@@ -1038,7 +1529,7 @@ class CloudLink(API):
                             if self.debug:
                                 print("Error on _on_connection_server: {0}".format(e))
                             self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
-                    threading.Thread(target=run).start()
+                    self.workers.submit(client["id"], run, force=True) # Never drop connection callbacks
             except Exception as e:
                 if self.debug:
                     print("Error on _on_connection_server: {0}".format(e))
@@ -1053,27 +1544,38 @@ class CloudLink(API):
                     else:
                         print("Connection closed: {0} ({1})".format(str(client['id']), str(self.statedata["ulist"]["objs"][client['id']]["username"])))
                 
-                if not self.callback_function["on_close"] == None:
-                    try:
-                        self.callback_function["on_close"](client)
-                    except Exception as e:
-                        if self.debug:
-                            print("Error on _closed_connection_server: {0}".format(e))
-                
-                # Remove entries from username list and userlist objects
-                if self.statedata["ulist"]["objs"][client['id']]["username"] in self.statedata["ulist"]["usernames"]:
-                    del self.statedata["ulist"]["usernames"][self.statedata["ulist"]["objs"][client['id']]["username"]]
-                del self.statedata["ulist"]["objs"][client['id']]
-
-                if self.statedata["secure_enable"]:
-                    if client in self.statedata["trusted"]:
-                        self.statedata["trusted"].remove(client)
-
-                self._send_to_all({"cmd": "ulist", "val": self._get_ulist()})
+                # Queued behind the client's on_connect and packets, so they never see it half removed
+                self.workers.submit(client["id"], self._remove_client, client, force=True) # Never drop connection callbacks
             except Exception as e:
                 if self.debug:
                     print("Error on _closed_connection_server: {0}".format(e))
     
+    def _remove_client(self, client): # Runs on_close and removes a client from the ulist, also used directly to log a client out straight away when kicking it
+        try:
+            if not client['id'] in self.statedata["ulist"]["objs"]:
+                return # Already removed, e.g. kicked before its connection closed
+            
+            if not self.callback_function["on_close"] == None:
+                try:
+                    self.callback_function["on_close"](client)
+                except Exception as e:
+                    if self.debug:
+                        print("Error on _remove_client: {0}".format(e))
+            
+            # Remove entries from username list and userlist objects
+            username = self.statedata["ulist"]["objs"][client['id']]["username"]
+            changed = self._remove_username(username)
+            del self.statedata["ulist"]["objs"][client['id']]
+
+            if self.statedata["secure_enable"]:
+                self.statedata["trusted"].pop(client["id"], None)
+
+            if changed:
+                self._send_ulist_update("ulist_remove", username)
+        except Exception as e:
+            if self.debug:
+                print("Error on _remove_client: {0}".format(e))
+    
     def _on_packet_server(self, client, server, message): # Server-side new packet handler (Gives it's powers to _server_packet_handler)
         if not type(client) == type(None):
             try:
@@ -1122,7 +1624,7 @@ class CloudLink(API):
                                                         else:
                                                             self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["IPRequred"]}))
                                                     else:
-                                                        self.statedata["trusted"].append(client)
+                                                        self.statedata["trusted"][client["id"]] = client
                                                         if self.debug:
                                                             print("Trusting user {0}".format(client["id"]))
 
@@ -1173,7 +1675,12 @@ class CloudLink(API):
                                 if self.debug:
                                     print("Error on _on_packet_server: {0}".format(e))
                                 self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
-                        threading.Thread(target=run).start()
+                        if not self.workers.submit(client["id"], run):
+                            # Too many packets queued up, tell the client to slow down
+                            if listener_detected:
+                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["RateLimit"], "listener": listener_id}))
+                            else:
+                                self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["RateLimit"]}))
                 else:
                     def run(*args):
                         try:
@@ -1192,7 +1699,17 @@ class CloudLink(API):
                             if self.debug:
                                 print("Error on _on_packet_server: {0}".format(e))
                             self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["InternalServerError"]}))
-                    threading.Thread(target=run).start()
+                    if not self.workers.submit(client["id"], run):
+                        # Too many packets queued up, tell the client to slow down
+                        try:
+                            msg = json.loads(message)
+                            listener_detected = (("listener" in msg) and (type(msg["listener"]) == str))
+                        except:
+                            listener_detected = False
+                        if listener_detected:
+                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["RateLimit"], "listener": msg["listener"]}))
+                        else:
+                            self.wss.send_message(client, json.dumps({"cmd": "statuscode", "val": self.codes["RateLimit"]}))
             except Exception as e:
                 try:
                     msg = json.loads(message)
@@ -1223,7 +1740,7 @@ class CloudLink(API):
                     except Exception as e:
                         if self.debug:
                             print("Error on _on_connection_client: {0}".format(e))
-                threading.Thread(target=run).start()
+                self.workers.submit("server", run, force=True)
         except Exception as e:
             if self.debug:
                 print("Error on _on_connection_client: {0}".format(e))
@@ -1247,7 +1764,7 @@ class CloudLink(API):
                     except Exception as e:
                         if self.debug:
                             print("Error on _on_packet_client: {0}".format(e))
-                threading.Thread(target=run).start()
+                self.workers.submit("server", run, force=True)
         except Exception as e:
             if self.debug:
                 print("Error on _on_packet_client: {0}".format(e))
@@ -1263,7 +1780,7 @@ class CloudLink(API):
                     except Exception as e:
                         if self.debug:
                             print("Error on _on_error_client: {0}".format(e))
-                threading.Thread(target=run).start()
+                self.workers.submit("server", run, force=True)
         except Exception as e:
             if self.debug:
                 print("Error on _on_error_client: {0}".format(e))
@@ -1279,7 +1796,7 @@ class CloudLink(API):
                     except Exception as e:
                         if self.debug:
                             print("Error on _closed_connection_client: {0}".format(e))
-                threading.Thread(target=run).start()
+                self.workers.submit("server", run, force=True)
         except Exception as e:
             if self.debug:
                 print("Error on _closed_connection_client: {0}".format(e))
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+"""
+CloudLink server load test
+
+Starts a bare CloudLink server in a subprocess, opens a number of idle
+connections to it, then measures ping round trips from some of them.
+Reports connections per GB of server memory and ping latency, so the
+threaded and asyncio server modes can be compared.
+
+Usage:
+    python cloudlink_loadtest.py --mode threaded --connections 1000
+    python cloudlink_loadtest.py --mode asyncio --connections 20000
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(mode, port):
+    from cloudlink import CloudLink
+
+    raise_fd_limit()
+    cl = CloudLink(workers=8, max_queue_depth=1000)
+    cl.server(ip="127.0.0.1", port=port, use_asyncio=(mode == "asyncio"))
+
+
+def get_rss(pid):
+    with open("/proc/{0}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+class Client:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((
+            "GET / HTTP/1.1\r\n"
+            "Host: 127.0.0.1:{0}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Key: {1}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        ).format(port, key).encode())
+        response = await reader.readuntil(b"\r\n\r\n")
+        if not response.startswith(b"HTTP/1.1 101"):
+            raise ConnectionError("Handshake failed")
+        return cls(reader, writer)
+
+    def send(self, message):
+        payload = json.dumps(message).encode()
+        mask = os.urandom(4)
+        header = bytearray([0x81])
+        if len(payload) <= 125:
+            header.append(0x80 | len(payload))
+        elif len(payload) <= 65535:
+            header.append(0x80 | 126)
+            header.extend(struct.pack(">H", len(payload)))
+        else:
+            header.append(0x80 | 127)
+            header.extend(struct.pack(">Q", len(payload)))
+        masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        self.writer.write(bytes(header) + mask + masked)
+
+    async def recv(self):
+        head = await self.reader.readexactly(2)
+        length = head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", await self.reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", await self.reader.readexactly(8))[0]
+        payload = await self.reader.readexactly(length)
+        if head[0] & 0x0F == 0x8:
+            raise ConnectionError("Closed by the server")
+        return json.loads(payload)
+
+    async def ping(self):
+        start = time.perf_counter()
+        self.send({"cmd": "ping", "val": ""})
+        while True:
+            message = await self.recv()
+            if message["cmd"] == "ping":
+                return time.perf_counter() - start
+
+
+async def run(port, pid, connections, batch_size, pingers, pings):
+    rss_before = get_rss(pid)
+    clients = []
+    start = time.perf_counter()
+    for i in range(0, connections, batch_size):
+        # websocket_server only has a small listen backlog, so connect in batches
+        batch = await asyncio.gather(
+            *[asyncio.wait_for(Client.connect(port), 10) for i in range(min(batch_size, connections - i))],
+            return_exceptions=True
+        )
+        for client in batch:
+            if isinstance(client, Exception):
+                print("Failed to connect: {0}".format(repr(client)))
+            else:
+                clients.append(client)
+    connect_time = time.perf_counter() - start
+    await asyncio.sleep(1)
+    rss_after = get_rss(pid)
+
+    latencies = []
+    for i in range(pings):
+        latencies.extend(await asyncio.gather(*[client.ping() for client in clients[:pingers]]))
+    latencies.sort()
+
+    for client in clients:
+        client.writer.close()
+
+    used = max(rss_after - rss_before, 1)
+    print("Connections:        {0} ({1:.2f}s to connect)".format(len(clients), connect_time))
+    print("Server memory:      {0:.1f} MB before, {1:.1f} MB after".format(rss_before / 2**20, rss_after / 2**20))
+    print("Connections per GB: {0:.0f}".format(len(clients) / (used / 2**30)))
+    print("Ping latency:       p50 {0:.2f}ms, p99 {1:.2f}ms, max {2:.2f}ms ({3} pings)".format(
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000,
+        latencies[-1] * 1000,
+        len(latencies)
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--port", type=int, default=3100)
+    parser.add_argument("--connections", type=int, default=5000, help="idle connections to open")
+    parser.add_argument("--batch", type=int, default=50, help="connections to open at a time")
+    parser.add_argument("--pingers", type=int, default=100, help="connections that measure ping latency")
+    parser.add_argument("--pings", type=int, default=20, help="pings sent by each pinger")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.mode, args.port)
+        return
+
+    raise_fd_limit()
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", "--mode", args.mode, "--port", str(args.port)],
+        stdout=subprocess.DEVNULL
+    )
+    try:
+        if not wait_for_port(args.port):
+            print("Server didn't start")
+            sys.exit(1)
+        print("Mode:               {0}".format(args.mode))
+        asyncio.run(run(args.port, server.pid, args.connections, args.batch, args.pingers, args.pings))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
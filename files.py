@@ -1,4 +1,5 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING, TEXT
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import time
 from uuid import uuid4
 
@@ -13,6 +14,37 @@ This file should be modified/refactored to interact with a JSON-friendly databas
 
 """
 
+# Indexes for the query shapes used by meower.py, rest_api.py and security.py, any other index is dropped
+# An index is a list of keys, or a tuple of the keys and options for create_index
+INDEXES = {
+    "posts": [
+        # Home and chat pages {post_origin, isDeleted} sorted by t.e (and _id for cursors), and their counts
+        [("post_origin", ASCENDING), ("isDeleted", ASCENDING), ("t.e", DESCENDING), ("_id", DESCENDING)],
+        # User post pages and inboxes {u, post_origin, isDeleted} sorted by t.e, plus {u, ...} when deleting or banning a user
+        [("u", ASCENDING), ("post_origin", ASCENDING), ("isDeleted", ASCENDING), ("t.e", DESCENDING), ("_id", DESCENDING)],
+        # Searching home, Meower.searchPosts
+        [("p", TEXT)]
+    ],
+    "usersv0": [
+        # Case-insensitive username lookups, and prefix searches with an anchored regex in Meower.searchUsers.
+        # Unique, so two accounts can't have names that only differ in case
+        ([("lower_username", ASCENDING)], {"unique": True})
+    ],
+    "netlog": [
+        [("users", ASCENDING)]
+    ],
+    "chats": [
+        [("members", ASCENDING)],
+        [("owner", ASCENDING)]
+    ],
+    "tokens": [
+        # Revoking every session of a user
+        [("u", ASCENDING)],
+        # Mongo deletes sessions once they expire
+        ([("expires", ASCENDING)], {"expireAfterSeconds": 0})
+    ]
+}
+
 class Files:
     def __init__(self, logger, errorhandler):
         self.log = logger
@@ -28,21 +60,19 @@ class Files:
         else:
             self.log("Connected to database")
 
+        # Cache the collection names, so operations don't need a round trip to check them
+        self.collections = set(self.db.list_collection_names())
+
         # Create database collections
-        for item in ["config", "usersv0", "usersv1", "netlog", "posts", "chats", "reports"]:
-            if not item in self.db.list_collection_names():
+        for item in ["config", "usersv0", "usersv1", "netlog", "posts", "chats", "reports", "tokens"]:
+            if not item in self.collections:
                 self.log("Creating collection {0}".format(item))
                 self.db.create_collection(name=item)
+                self.collections.add(item)
         
         # Create collection indexes
-        self.db["netlog"].create_index("users")
-        self.db["usersv0"].create_index("lower_username")
-        self.db["posts"].create_index("u")
-        self.db["posts"].create_index("post_origin")
-        self.db["posts"].create_index("type")
-        self.db["posts"].create_index("p")
-        self.db["chats"].create_index("members")
-        
+        self.ensure_indexes()
+
         # Create reserved accounts
         for username in ["Server", "Deleted", "Meower", "Admin", "username"]:
             self.create_item("usersv0", username, {
@@ -61,7 +91,6 @@ class Files:
                 "quote": None,
                 "email": None,
                 "pswd": None,
-                "tokens": [],
                 "lvl": None,
                 "banned": False,
                 "last_ip": None
@@ -101,9 +130,66 @@ class Files:
 
         self.log("Files initialized!")
 
+    def ensure_indexes(self):
+        for collection, indexes in INDEXES.items():
+            names = ["_id_"]
+            existing = self.db[collection].index_information()
+            for index in indexes:
+                if type(index) == tuple:
+                    keys, options = index
+                else:
+                    keys, options = index, {}
+                
+                # An index on the same keys with different options has to be rebuilt, Mongo won't change it in place
+                for name, info in existing.items():
+                    if (info["key"] == keys) and any(info.get(option) != value for option, value in options.items()):
+                        self.log("Rebuilding index {0} on {1}".format(name, collection))
+                        self.db[collection].drop_index(name)
+                
+                try:
+                    names.append(self.db[collection].create_index(keys, **options))
+                except OperationFailure as e:
+                    self.log("Failed to create index {0} on {1} with {2}: {3}".format(keys, collection, options, e))
+                    if options.get("unique"):
+                        # Existing items break it. A plain index would lose the guarantee, so they have to be fixed first
+                        self.log_duplicates(collection, [key for key, direction in keys])
+                    raise
+            
+            # Drop indexes nothing queries by anymore, they only slow down writes
+            for name in self.db[collection].index_information().keys():
+                if not name in names:
+                    self.log("Dropping unused index {0} on {1}".format(name, collection))
+                    self.db[collection].drop_index(name)
+
+    def log_duplicates(self, collection, fields):
+        # Logs the items that share values of fields, e.g. accounts whose usernames only differ in case
+        pipeline = [
+            {"$group": {"_id": {field: "${0}".format(field) for field in fields}, "items": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}}
+        ]
+        for group in self.db[collection].aggregate(pipeline):
+            self.log("Duplicate {0} in {1}: {2}".format(group["_id"], collection, ", ".join(str(item) for item in group["items"])))
+
+    def get_query_plan(self, collection, query, sort=None):
+        # Returns the stages of the plan Mongo picks for a query, e.g. ["LIMIT", "FETCH", "IXSCAN"]
+        cursor = self.db[collection].find(query)
+        if sort != None:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        plan = plan.get("queryPlan", plan) # Slot based execution engine
+        stages = []
+        pending = [plan]
+        while len(pending) > 0:
+            stage = pending.pop(0)
+            stages.append(stage["stage"])
+            if "inputStage" in stage:
+                pending.append(stage["inputStage"])
+            pending.extend(stage.get("inputStages", []))
+        return stages
+
     def does_item_exist(self, collection, id):
-        if collection in self.db.list_collection_names():
-            if self.db[collection].find_one({"_id": id}) != None:
+        if collection in self.collections:
+            if self.db[collection].find_one({"_id": id}, projection={"_id": 1}) != None:
                 return True
             else:
                 return False
@@ -111,12 +197,13 @@ class Files:
             return False
              
     def create_item(self, collection, id, data):
-        if collection in self.db.list_collection_names():
-            if not self.does_item_exist(collection, id):
-                data["_id"] = id
+        if collection in self.collections:
+            # The unique _id index makes the insert fail if the item exists, no need to check first
+            data["_id"] = id
+            try:
                 self.db[collection].insert_one(data)
                 return True
-            else:
+            except DuplicateKeyError:
                 self.log("{0} already exists in {1}".format(id, collection))
                 return False
         else:
@@ -124,9 +211,28 @@ class Files:
             return False
 
     def update_item(self, collection, id, data):
-        if collection in self.db.list_collection_names():
-            if self.does_item_exist(collection, id):
-                self.db[collection].update_one({"_id": id}, {"$set": data})
+        if collection in self.collections:
+            if self.db[collection].update_one({"_id": id}, {"$set": data}).matched_count > 0:
+                return True
+            else:
+                return False
+        else:
+            return False
+
+    def modify_item(self, collection, id, set_data=None, pull_data=None, add_data=None, upsert=False):
+        # Partial update, only the changed fields and list items are sent instead of the whole item
+        if collection in self.collections:
+            update = {}
+            if set_data:
+                update["$set"] = set_data
+            if pull_data:
+                update["$pull"] = pull_data
+            if add_data:
+                update["$addToSet"] = add_data
+            if len(update) == 0:
+                return self.does_item_exist(collection, id)
+            result = self.db[collection].update_one({"_id": id}, update, upsert=upsert)
+            if (result.matched_count > 0) or (result.upserted_id != None):
                 return True
             else:
                 return False
@@ -134,44 +240,54 @@ class Files:
             return False
 
     def write_item(self, collection, id, data):
-        if collection in self.db.list_collection_names():
-            if self.does_item_exist(collection, id):
-                data["_id"] = id
-                self.db[collection].find_one_and_replace({"_id": id}, data)
+        if collection in self.collections:
+            data["_id"] = id
+            if self.db[collection].replace_one({"_id": id}, data).matched_count > 0:
                 return True
             else:
                 return False
         else:
             return False
 
-    def load_item(self, collection, id):
-        if collection in self.db.list_collection_names():
-            if self.does_item_exist(collection, id):
-                return True, self.db[collection].find_one({"_id": id})
+    def load_item(self, collection, id, projection=None):
+        if collection in self.collections:
+            item = self.db[collection].find_one({"_id": id}, projection=projection)
+            if item != None:
+                return True, item
+            else:
+                return False, None
+        else:
+            return False, None
+
+    def find_item(self, collection, query, projection=None):
+        # Like load_item, for the first item matching a query
+        if collection in self.collections:
+            item = self.db[collection].find_one(query, projection=projection)
+            if item != None:
+                return True, item
             else:
                 return False, None
         else:
             return False, None
 
     def find_items(self, collection, query):
-        if collection in self.db.list_collection_names():
+        if collection in self.collections:
             payload = []
-            for item in self.db[collection].find(query):
+            for item in self.db[collection].find(query, projection={"_id": 1}):
                 payload.append(item["_id"])
             return payload
         else:
             return []
 
     def count_items(self, collection, query):
-        if collection in self.db.list_collection_names():
+        if collection in self.collections:
             return self.db[collection].count_documents(query)
         else:
             return 0
 
     def delete_item(self, collection, id):
-        if collection in self.db.list_collection_names():
-            if self.does_item_exist(collection, id):
-                self.db[collection].delete_one({"_id": id})
+        if collection in self.collections:
+            if self.db[collection].delete_one({"_id": id}).deleted_count > 0:
                 return True
             else:
                 return False
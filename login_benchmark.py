@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+Login hashing benchmark
+
+Checks passwords from a number of threads at once, the way authpswd does
+when a lot of clients log in together, first with bcrypt called directly
+on the threads and then through the hash pool in security.py. Reports
+logins per second, and how late a thread that should wake up every 10ms
+(standing in for the threads handling packets) gets while it runs.
+
+With --costs, it instead times hashing and checking a password at each
+bcrypt cost (the hash_strength Security is given) on this machine, to pick
+one that fits the login latency budget.
+
+Doesn't need MongoDB.
+
+Usage:
+    python login_benchmark.py --threads 32 --logins 256
+    python login_benchmark.py --processes 4 --ips 1 (everything from one IP)
+    python login_benchmark.py --costs 10-14
+"""
+
+import argparse
+import os
+import threading
+import time
+
+from security import HashPool, check_password, hash_password
+
+
+def measure_lag(stop, lags, interval=0.01):
+    while not stop.is_set():
+        start = time.perf_counter()
+        time.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+def run(check, threads, logins, ips):
+    stop = threading.Event()
+    lags = []
+    lagger = threading.Thread(target=measure_lag, args=(stop, lags))
+    lagger.start()
+
+    lock = threading.Lock()
+    results = {"ok": 0, "rejected": 0}
+    remaining = [logins]
+
+    def worker(index):
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+                login = remaining[0]
+            result = check("10.0.0.{0}".format(login % ips))
+            with lock:
+                results["ok" if result else "rejected"] += 1
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    lagger.join()
+    lags.sort()
+    return results, elapsed, lags
+
+
+def report(name, results, elapsed, lags):
+    print("{0:<8} {1:>8.1f} logins/s  {2:>5} rejected  lag p50 {3:.2f}ms, p99 {4:.2f}ms, max {5:.2f}ms".format(
+        name,
+        results["ok"] / elapsed,
+        results["rejected"],
+        lags[len(lags) // 2] * 1000,
+        lags[int(len(lags) * 0.99)] * 1000,
+        lags[-1] * 1000
+    ))
+
+
+def time_costs(costs, repeat):
+    password = "benchmark password"
+    print("{0:<6} {1:>10} {2:>10} {3:>16}".format("cost", "hash (ms)", "check (ms)", "logins/s/core"))
+    for cost in costs:
+        hashes = []
+        checks = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            hashed_pw = hash_password(password, cost)
+            hashes.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            check_password(password, hashed_pw)
+            checks.append(time.perf_counter() - start)
+        hashes.sort()
+        checks.sort()
+        check_time = checks[len(checks) // 2]
+        print("{0:<6} {1:>10.1f} {2:>10.1f} {3:>16.1f}".format(cost, hashes[len(hashes) // 2] * 1000, check_time * 1000, 1 / check_time))
+    print("({0} cores)".format(os.cpu_count()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=32, help="logins in progress at once")
+    parser.add_argument("--logins", type=int, default=256)
+    parser.add_argument("--ips", type=int, default=64, help="different IPs the logins come from")
+    parser.add_argument("--processes", type=int, default=None, help="hash pool size, defaults to one per core")
+    parser.add_argument("--strength", type=int, default=12, help="bcrypt cost of the test password")
+    parser.add_argument("--costs", help="time each bcrypt cost in a range (e.g. 10-14) and exit")
+    parser.add_argument("--repeat", type=int, default=5, help="times to hash at each cost with --costs, the median is shown")
+    args = parser.parse_args()
+
+    if args.costs:
+        first, last = args.costs.split("-") if "-" in args.costs else (args.costs, args.costs)
+        time_costs(range(int(first), int(last) + 1), args.repeat)
+        return
+
+    password = "benchmark password"
+    hashed_pw = hash_password(password, args.strength)
+
+    report("direct", *run(lambda ip: check_password(password, hashed_pw), args.threads, args.logins, args.ips))
+
+    pool = HashPool(processes=args.processes)
+    pool.run(None, check_password, password, hashed_pw) # Start the processes before timing
+    report("pool", *run(lambda ip: pool.run(ip, check_password, password, hashed_pw)[0], args.threads, args.logins, args.ips))
+    print("Pool: {0} processes, {1}".format(pool.processes, pool.get_stats()))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ from supporter import Supporter
 from security import Security
 from files import Files
 from meower import Meower
-from rest_api import app as rest_api_app
+import rest_api
 from threading import Thread
 
 """
@@ -39,7 +39,8 @@ class Main:
             files = self.filesystem,
             supporter = self.supporter,
             logger = self.supporter.log,
-            errorhandler = self.supporter.full_stack
+            errorhandler = self.supporter.full_stack,
+            workers = self.cl.workers
         )
         
         # Initialize Meower
@@ -57,17 +58,22 @@ class Main:
         if result:
             self.cl.trustedAccess(True, payload["index"])
         
-        # Load IP Banlist
+        # Load IP Banlist, wildcard bans may be CIDR ranges
         ips = []
         for netlog in self.filesystem.db["netlog"].find({"blocked": True}):
             ips.append(netlog["_id"])
+        result, payload = self.filesystem.load_item("config", "IPBanlist")
+        if result:
+            ips.extend(payload["wildcard"])
         self.cl.loadIPBlocklist(ips)
         
         # Set server MOTD
         self.cl.setMOTD("Meower Social Media Platform Server", True)
-        
+    
+    def run(self):
         # Run REST API
-        Thread(target=rest_api_app.run, kwargs={"host": "0.0.0.0", "port": 3001, "debug": False, "use_reloader": False}).start()
+        rest_api.init(self.supporter, self.filesystem, self.accounts, self.meower)
+        Thread(target=rest_api.app.run, kwargs={"host": "0.0.0.0", "port": 3001, "debug": False, "use_reloader": False}).start()
 
         # Run CloudLink server
         self.cl.server(port=3000, ip="0.0.0.0")
@@ -134,4 +140,4 @@ class Main:
             self.returnCode(code = "InternalServerError", client = client, listener_detected = listener_detected, listener_id = listener_id)
 
 if __name__ == "__main__":
-    Main(debug=True)
\ No newline at end of file
+    Main(debug=True).run()
\ No newline at end of file
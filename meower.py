@@ -1,10 +1,15 @@
 import time
 import uuid
 import secrets
+import base64
+import re
 import pymongo
+import threading
+from collections import OrderedDict
 import os
 from dotenv import load_dotenv
 import requests
+from cloudlink import IPBlocklist
 
 load_dotenv()  # take environment variables from .env.
 
@@ -17,6 +22,28 @@ class Meower:
         self.accounts = accounts
         self.filesystem = files
         self.sendPacket = self.supporter.sendPacket
+
+        # Live post counts per (post_origin, user) for page counts, a user of None counts everyone's posts.
+        # They're kept up to date as posts are made and deleted, and recounted from the database every index_count_ttl seconds.
+        self.index_counts = OrderedDict()
+        self.index_counts_lock = threading.Lock()
+        self.index_counts_size = 10000
+        self.index_count_ttl = 300
+
+        # The newest home posts, newest first, so the first pages of home don't need the database.
+        # Kept up to date as posts are made and deleted (the REST API shares this instance), and reloaded
+        # every home_buffer_ttl seconds to pick up changes made straight to the database.
+        self.home_buffer = []
+        self.home_buffer_lock = threading.Lock()
+        self.home_buffer_size = 100
+        self.home_buffer_ttl = 10
+        self.home_buffer_complete = False # True if there are no home posts older than the buffer
+        self.home_buffer_expires = 0
+        self.loadHomeBuffer()
+
+        # Search limits, so one search can't make the database do unbounded work
+        self.search_max_terms = 10
+        self.search_max_results = 250
         result, self.supporter.filter = self.filesystem.load_item("config", "filter")
         if not result:
             self.log("Failed to load profanity filter, default will be used as fallback!")
@@ -35,13 +62,168 @@ class Meower:
         except ValueError:
             return False
 
-    def getIndex(self, location="posts", query={"post_origin": "home", "isDeleted": False},  truncate=False, page=1, sort="t.e"):
-        if truncate:
-            all_items = self.filesystem.db[location].find(query).sort("t.e", pymongo.DESCENDING).skip((page-1)*25).limit(25)
+    def encodeIndexCursor(self, item):
+        # Opaque to clients, it's the sort key of the last item they got
+        return base64.urlsafe_b64encode("{0}:{1}".format(item["t"]["e"], item["_id"]).encode()).decode()
+
+    def decodeIndexCursor(self, cursor):
+        try:
+            timestamp, item_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":", 1)
+            return int(timestamp), item_id
+        except Exception:
+            return None
+
+    def getIndexCountKeys(self, location, query):
+        # Returns the counters that add up to the query's count, or None if the query isn't a maintained index
+        if (location != "posts") or (query.get("isDeleted") != False) or (type(query.get("post_origin")) != str):
+            return None
+        for key in query.keys():
+            if not key in ["post_origin", "u", "isDeleted"]:
+                return None
+        if not "u" in query:
+            return [(query["post_origin"], None)]
+        elif type(query["u"]) == str:
+            return [(query["post_origin"], query["u"])]
+        elif (type(query["u"]) == dict) and (list(query["u"].keys()) == ["$in"]) and all(type(user) == str for user in query["u"]["$in"]):
+            return [(query["post_origin"], user) for user in set(query["u"]["$in"])]
         else:
-            all_items = self.filesystem.db[location].find(query)
+            return None
+
+    def getIndexCount(self, key):
+        with self.index_counts_lock:
+            if (key in self.index_counts) and (time.monotonic() < self.index_counts[key]["expires"]):
+                self.index_counts.move_to_end(key)
+                return self.index_counts[key]["count"]
+        
+        # Missing or due for reconciliation, recount it
+        query = {"post_origin": key[0], "isDeleted": False}
+        if key[1] != None:
+            query["u"] = key[1]
+        count = self.filesystem.count_items("posts", query)
+        with self.index_counts_lock:
+            self.index_counts[key] = {"count": count, "expires": time.monotonic() + self.index_count_ttl}
+            self.index_counts.move_to_end(key)
+            while len(self.index_counts) > self.index_counts_size:
+                self.index_counts.popitem(last=False)
+        return count
+
+    def adjustIndexCount(self, post_origin, user, change):
+        with self.index_counts_lock:
+            for key in [(post_origin, None), (post_origin, user)]:
+                if key in self.index_counts:
+                    self.index_counts[key]["count"] = max(self.index_counts[key]["count"] + change, 0)
+
+    def countIndex(self, location, query):
+        keys = self.getIndexCountKeys(location, query)
+        if keys == None:
+            return self.filesystem.count_items(location, query)
+        item_count = 0
+        for key in keys:
+            item_count += self.getIndexCount(key)
+        return item_count
+
+    def setPostDeleted(self, post):
+        result = self.filesystem.update_item("posts", post["_id"], {"isDeleted": True})
+        if result and (not post["isDeleted"]):
+            self.adjustIndexCount(post["post_origin"], post["u"], -1)
+        if result and (post["post_origin"] == "home"):
+            self.removeFromHomeBuffer(post["_id"])
+        return result
+
+    def isHomeIndex(self, location, query):
+        return (location == "posts") and (query == {"post_origin": "home", "isDeleted": False})
+
+    def loadHomeBuffer(self):
+        posts = list(self.filesystem.db["posts"].find({"post_origin": "home", "isDeleted": False}).sort([("t.e", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]).limit(self.home_buffer_size))
+        with self.home_buffer_lock:
+            if [post["_id"] for post in posts] != [post["_id"] for post in self.home_buffer]:
+                if self.home_buffer_expires != 0:
+                    self.log("Home buffer was out of date, reloaded it from the database")
+            self.home_buffer = posts
+            self.home_buffer_complete = (len(posts) < self.home_buffer_size)
+            self.home_buffer_expires = time.monotonic() + self.home_buffer_ttl
+
+    def readHomeBuffer(self, start, cursor_key, count):
+        # Returns count posts starting at the start'th post, or after cursor_key if it's given.
+        # Returns None if the buffer doesn't hold all of them, so they need to come from the database.
+        if (time.monotonic() >= self.home_buffer_expires) or ((len(self.home_buffer) < (self.home_buffer_size // 2)) and (not self.home_buffer_complete)):
+            self.loadHomeBuffer()
+        with self.home_buffer_lock:
+            if cursor_key != None:
+                start = 0
+                while (start < len(self.home_buffer)) and ((self.home_buffer[start]["t"]["e"], self.home_buffer[start]["_id"]) >= cursor_key):
+                    start += 1
+            if (start < 0) or ((start + count > len(self.home_buffer)) and (not self.home_buffer_complete)):
+                return None
+            return [post.copy() for post in self.home_buffer[start:(start + count)]]
+
+    def addToHomeBuffer(self, post):
+        key = (post["t"]["e"], post["_id"])
+        with self.home_buffer_lock:
+            index = 0
+            while (index < len(self.home_buffer)) and ((self.home_buffer[index]["t"]["e"], self.home_buffer[index]["_id"]) > key):
+                index += 1
+            self.home_buffer.insert(index, post.copy())
+            if len(self.home_buffer) > self.home_buffer_size:
+                self.home_buffer.pop()
+                self.home_buffer_complete = False
+
+    def removeFromHomeBuffer(self, post_id):
+        with self.home_buffer_lock:
+            self.home_buffer = [post for post in self.home_buffer if post["_id"] != post_id]
+
+    def getIndex(self, location="posts", query={"post_origin": "home", "isDeleted": False},  truncate=False, page=1, sort="t.e", cursor=None):
+        if truncate and (cursor != None):
+            # Keyset pagination, the next page starts after the last item of the previous one using the (t.e, _id) order,
+            # so deep pages don't skip over every item before them and there's no count. An empty or invalid cursor gets the first page.
+            page_query = query
+            cursor_key = self.decodeIndexCursor(cursor)
+            if cursor_key != None:
+                page_query = {"$and": [query, {"$or": [
+                    {"t.e": {"$lt": cursor_key[0]}},
+                    {"t.e": cursor_key[0], "_id": {"$lt": cursor_key[1]}}
+                ]}]}
+            query_get = None
+            if self.isHomeIndex(location, query):
+                query_get = self.readHomeBuffer(0, cursor_key, 26)
+            if query_get == None:
+                query_get = list(self.filesystem.db[location].find(page_query).sort([("t.e", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]).limit(26))
+            if len(query_get) > 25:
+                query_get = query_get[:25]
+                next_cursor = self.encodeIndexCursor(query_get[-1])
+            else:
+                next_cursor = None
+            
+            return {
+                "query": query,
+                "index": query_get,
+                "next": next_cursor
+            }
+        
+        query_get = None
+        if truncate and self.isHomeIndex(location, query):
+            query_get = self.readHomeBuffer((page-1)*25, None, 25)
+        if query_get == None:
+            if truncate:
+                all_items = self.filesystem.db[location].find(query).sort([("t.e", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]).skip((page-1)*25).limit(25)
+            else:
+                all_items = self.filesystem.db[location].find(query)
+            query_get = []
+            for item in all_items:
+                query_get.append(item)
+        
+        item_count = self.countIndex(location, query)
+        
+        query_return = {
+            "query": query,
+            "index": query_get,
+            "page#": page,
+            "pages": self.countPages(item_count)
+        }
         
-        item_count = self.filesystem.db[location].count_documents(query)
+        return query_return
+
+    def countPages(self, item_count):
         if item_count == 0:
             pages = 0
         else:
@@ -52,19 +234,54 @@ class Meower:
                     pages = (item_count // 25)
             else:
                 pages = (item_count // 25)+1
+        return pages
+
+    def escapeSearchQuery(self, query):
+        # $text reads quotes as phrases and a leading - as "not", only plain words get searched for
+        words = []
+        for word in query.replace('"', " ").split():
+            word = word.lstrip("-")
+            if len(word) > 0:
+                words.append(word)
+        return " ".join(words[:self.search_max_terms])
 
+    def searchPosts(self, query, page=1):
+        # Ranked by relevance using the text index on p, then newest first
+        search = self.escapeSearchQuery(query[:360])
+        db_query = {"post_origin": "home", "isDeleted": False, "$text": {"$search": search}}
         query_get = []
-        for item in all_items:
-            query_get.append(item)
+        item_count = 0
+        if (search != "") and (page >= 1) and (((page-1)*25) < self.search_max_results):
+            all_items = self.filesystem.db["posts"].find(db_query, projection={"score": {"$meta": "textScore"}}).sort([("score", {"$meta": "textScore"}), ("t.e", pymongo.DESCENDING)]).skip((page-1)*25).limit(min(25, self.search_max_results - ((page-1)*25)))
+            for item in all_items:
+                del item["score"]
+                query_get.append(item)
+            item_count = self.filesystem.db["posts"].count_documents(db_query, limit=self.search_max_results)
         
-        query_return = {
-            "query": query,
+        return {
+            "query": {"post_origin": "home", "isDeleted": False, "search": search},
             "index": query_get,
             "page#": page,
-            "pages": pages
+            "pages": self.countPages(item_count)
         }
+
+    def searchUsers(self, query, page=1):
+        # Usernames starting with the query, an anchored regex can use the lower_username index
+        db_query = {"lower_username": {"$regex": "^{0}".format(re.escape(query[:20].lower()))}}
+        query_get = []
+        item_count = 0
+        if (page >= 1) and (((page-1)*25) < self.search_max_results):
+            all_items = self.filesystem.db["usersv0"].find(db_query, projection={"_id": 1, "lower_username": 1}).sort("lower_username", pymongo.ASCENDING).skip((page-1)*25).limit(min(25, self.search_max_results - ((page-1)*25)))
+            for item in all_items:
+                query_get.append(item)
+            item_count = self.filesystem.db["usersv0"].count_documents(db_query, limit=self.search_max_results)
         
-        return query_return
+        return {
+            "query": db_query,
+            "index": query_get,
+            "page#": page,
+            "pages": self.countPages(item_count)
+        }
 
     def createPost(self, post_origin, user, content):
         post_id = str(uuid.uuid4())
@@ -84,6 +301,8 @@ class Meower:
             result = self.filesystem.create_item("posts", post_id, post_data)
 
             if result:
+                self.adjustIndexCount(post_origin, user, 1)
+                self.addToHomeBuffer(post_data)
                 payload = post_data
                 payload["mode"] = 1
 
@@ -105,6 +324,7 @@ class Meower:
             result = self.filesystem.create_item("posts", post_id, post_data)
 
             if result:
+                self.adjustIndexCount(post_origin, user, 1)
                 payload = {
                     "mode": "inbox_message",
                     "payload": {}
@@ -150,6 +370,7 @@ class Meower:
                 result = self.filesystem.create_item("posts", post_id, post_data)
 
                 if result:
+                    self.adjustIndexCount(post_origin, user, 1)
                     # Remove code below once client is updated
                     payload = post_data
                     payload["state"] = 2
@@ -177,6 +398,107 @@ class Meower:
                         self.createPost("inbox", user, "Sadly, we could not take action on one of your recent reports. The content you reported was not severe enough to warrant action being taken. We still want to thank you for your help with keeping Meower a safe and welcoming place!")
                 self.filesystem.delete_item("reports", _id)
 
+    def finishAuthpswd(self, client, username, ip, listener_detected, listener_id, FileCheck, FileRead, ValidAuth, Banned):
+        # Finishes authpswd once the password has been checked, on a worker (see Security._after_hash)
+        if not (client["id"] in self.cl.statedata["ulist"]["objs"]):
+            return # Disconnected while the password was being checked
+        if FileCheck and FileRead:
+            if ValidAuth:
+                self.supporter.kickUser(username, status="IDConflict") # Kick bad clients missusing the username
+                status = self.filesystem.modify_item("netlog", ip, set_data={"last_user": username}, add_data={"users": username}, upsert=True)
+                if status:
+                    token = secrets.token_urlsafe(64)
+                    self.accounts.add_token(username, token, ip)
+                    self.supporter.autoID(client, username) # Give the client an AutoID
+                    self.supporter.setAuthenticatedState(client, True) # Make the server know that the client is authed
+                    # Return info to sender
+                    payload = {
+                        "mode": "auth",
+                        "payload": {
+                            "username": username,
+                            "token": token
+                        }
+                    }
+                    self.sendPacket({"cmd": "direct", "val": payload, "id": client}, listener_detected = listener_detected, listener_id = listener_id)
+
+                    # Tell the client it is authenticated
+                    self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
+
+                    # Log peak users
+                    self.supporter.log_peak_users()
+                else:
+                    self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
+            else:
+                if Banned:
+                    # Account banned
+                    self.returnCode(client = client, code = "Banned", listener_detected = listener_detected, listener_id = listener_id)
+                elif ValidAuth == None:
+                    # Too many passwords being checked right now
+                    self.returnCode(client = client, code = "RateLimit", listener_detected = listener_detected, listener_id = listener_id)
+                else:
+                    # Password invalid
+                    self.returnCode(client = client, code = "PasswordInvalid", listener_detected = listener_detected, listener_id = listener_id)
+        else:
+            if ((not FileCheck) and FileRead):
+                # Account does not exist
+                self.returnCode(client = client, code = "IDNotFound", listener_detected = listener_detected, listener_id = listener_id)
+            else:
+                # Some other error, raise an internal error.
+                self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
+
+    def finishGenAccount(self, client, username, ip, listener_detected, listener_id, FileCheck, FileWrite):
+        # Finishes gen_account once the password has been hashed and the account created
+        if not (client["id"] in self.cl.statedata["ulist"]["objs"]):
+            return # Disconnected while the password was being hashed
+        if FileCheck and FileWrite:
+            status = self.filesystem.modify_item("netlog", ip, set_data={"last_user": username}, add_data={"users": username}, upsert=True)
+            if status:
+                token = secrets.token_urlsafe(64)
+                self.accounts.add_token(username, token, ip)
+                self.supporter.autoID(client, username) # If the client is JS-based then give them an AutoID
+                self.supporter.setAuthenticatedState(client, True) # Make the server know that the client is authed
+
+                # Return info to sender
+                payload = {
+                    "mode": "auth",
+                    "payload": {
+                        "username": username,
+                        "token": token
+                    }
+                }
+
+                self.sendPacket({"cmd": "direct", "val": payload, "id": client}, listener_detected = listener_detected, listener_id = listener_id)
+
+                # Tell the client it is authenticated
+                self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
+
+                # Log peak users
+                self.supporter.log_peak_users()
+
+                # Send welcome message
+                self.createPost(post_origin="inbox", user=username, content="Welcome to Meower! We welcome you with open arms! You can get started by making friends in the global chat or home, or by searching for people and adding them to a group chat. We hope you have fun!")
+            else:
+                self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
+        else:
+            if ((not FileCheck) and FileWrite):
+                # Account already exists
+                self.returnCode(client = client, code = "IDExists", listener_detected = listener_detected, listener_id = listener_id)
+            elif FileCheck and (FileWrite == None):
+                # Too many passwords being hashed right now
+                self.returnCode(client = client, code = "RateLimit", listener_detected = listener_detected, listener_id = listener_id)
+            else:
+                # Some other error, raise an internal error.
+                self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
+
+    def finishChangePswd(self, client, listener_detected, listener_id, FileCheck, FileRead, FileWrite):
+        # Finishes change_pswd once the new password has been hashed and saved
+        if FileCheck and FileRead and FileWrite:
+            self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
+        elif FileCheck and FileRead and (FileWrite == None):
+            self.returnCode(client = client, code = "RateLimit", listener_detected = listener_detected, listener_id = listener_id)
+        else:
+            self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
+    
     def returnCode(self, client, code, listener_detected, listener_id):
         self.sendPacket({"cmd": "statuscode", "val": self.cl.codes[str(code)], "id": client}, listener_detected = listener_detected, listener_id = listener_id)
     
@@ -220,55 +542,9 @@ class Meower:
                     if ((type(username) == str) and (type(password) == str)):
                         if not self.supporter.checkForBadCharsUsername(username):
                             if not self.supporter.checkForBadCharsPost(password):
-                                if not (self.supporter.check_for_spam("login", ip, burst=5, seconds=60)) or (self.supporter.check_for_spam("login", username, burst=5, seconds=60)):
-                                    FileCheck, FileRead, ValidAuth, Banned = self.accounts.authenticate(username, password)
-                                    if FileCheck and FileRead:
-                                        if ValidAuth:
-                                            self.supporter.kickUser(username, status="IDConflict") # Kick bad clients missusing the username
-                                            self.filesystem.create_item("netlog", str(self.cl.statedata["ulist"]["objs"][client["id"]]["ip"]), {"users": [], "last_user": username})
-                                            status, netlog = self.filesystem.load_item("netlog", str(self.cl.statedata["ulist"]["objs"][client["id"]]["ip"]))
-                                            if status:
-                                                if not username in netlog["users"]:
-                                                    netlog["users"].append(username)
-                                                netlog["last_user"] = username
-                                                self.filesystem.write_item("netlog", str(self.cl.statedata["ulist"]["objs"][client["id"]]["ip"]), netlog)
-                                                FileCheck, FileRead, accountData = self.accounts.get_account(username, False, False)
-                                                token = secrets.token_urlsafe(64)
-                                                accountData["tokens"].append(token)
-                                                self.accounts.update_setting(username, {"last_ip": str(self.cl.statedata["ulist"]["objs"][client["id"]]["ip"]), "tokens": accountData["tokens"]}, forceUpdate=True)
-                                                self.supporter.autoID(client, username) # Give the client an AutoID
-                                                self.supporter.setAuthenticatedState(client, True) # Make the server know that the client is authed
-                                                # Return info to sender
-                                                payload = {
-                                                    "mode": "auth",
-                                                    "payload": {
-                                                        "username": username,
-                                                        "token": token
-                                                    }
-                                                }
-                                                self.sendPacket({"cmd": "direct", "val": payload, "id": client}, listener_detected = listener_detected, listener_id = listener_id)
-                                                
-                                                # Tell the client it is authenticated
-                                                self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
-                                                
-                                                # Log peak users
-                                                self.supporter.log_peak_users()
-                                            else:
-                                                self.returnCode(client = client, code = "Internal", listener_detected = listener_detected, listener_id = listener_id)
-                                        else:
-                                            if Banned:
-                                                # Account banned
-                                                self.returnCode(client = client, code = "Banned", listener_detected = listener_detected, listener_id = listener_id)
-                                            else:
-                                                # Password invalid
-                                                self.returnCode(client = client, code = "PasswordInvalid", listener_detected = listener_detected, listener_id = listener_id)
-                                    else:
-                                        if ((not FileCheck) and FileRead):
-                                            # Account does not exist
-                                            self.returnCode(client = client, code = "IDNotFound", listener_detected = listener_detected, listener_id = listener_id)
-                                        else:
-                                            # Some other error, raise an internal error.
-                                            self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
+                                # Rate limits are checked before any password hashing is queued
+                                if not (self.supporter.check_for_spam("login", ip, burst=5, seconds=60) or self.supporter.check_for_spam("login", username, burst=5, seconds=60)):
+                                    self.accounts.authenticate(username, password, ip=ip, callback=lambda *result: self.finishAuthpswd(client, username, ip, listener_detected, listener_id, *result))
                                 else:
                                     # Ratelimited
                                     self.returnCode(client = client, code = "RateLimit", listener_detected = listener_detected, listener_id = listener_id)
@@ -326,51 +602,7 @@ class Meower:
                                         self.log("No IPHub API key detected, skipping VPN/proxy check for {0}".format(ip))
 
                                 if not self.supporter.check_for_spam("signup", ip, burst=2, seconds=120):
-                                    FileCheck, FileWrite = self.accounts.create_account(username, password)
-                                    
-                                    if FileCheck and FileWrite:
-                                        self.filesystem.create_item("netlog", str(self.cl.statedata["ulist"]["objs"][client["id"]]["ip"]), {"users": [], "last_user": username})
-                                        status, netlog = self.filesystem.load_item("netlog", str(self.cl.statedata["ulist"]["objs"][client["id"]]["ip"]))
-                                        if status:
-                                            if not username in netlog["users"]:
-                                                netlog["users"].append(username)
-                                            netlog["last_user"] = username
-                                            self.filesystem.write_item("netlog", str(self.cl.statedata["ulist"]["objs"][client["id"]]["ip"]), netlog)
-                                            FileCheck, FileRead, accountData = self.accounts.get_account(username, False, False)
-                                            token = secrets.token_urlsafe(64)
-                                            accountData["tokens"].append(token)
-                                            self.accounts.update_setting(username, {"last_ip": str(self.cl.statedata["ulist"]["objs"][client["id"]]["ip"]), "tokens": accountData["tokens"]}, forceUpdate=True)
-                                            self.supporter.autoID(client, username) # If the client is JS-based then give them an AutoID
-                                            self.supporter.setAuthenticatedState(client, True) # Make the server know that the client is authed
-                                            
-                                            # Return info to sender
-                                            payload = {
-                                                "mode": "auth",
-                                                "payload": {
-                                                    "username": username,
-                                                    "token": token
-                                                }
-                                            }
-                                            
-                                            self.sendPacket({"cmd": "direct", "val": payload, "id": client}, listener_detected = listener_detected, listener_id = listener_id)
-                                            
-                                            # Tell the client it is authenticated
-                                            self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
-                                            
-                                            # Log peak users
-                                            self.supporter.log_peak_users()
-
-                                            # Send welcome message
-                                            self.createPost(post_origin="inbox", user=username, content="Welcome to Meower! We welcome you with open arms! You can get started by making friends in the global chat or home, or by searching for people and adding them to a group chat. We hope you have fun!")
-                                        else:
-                                            self.returnCode(client = client, code = "Internal", listener_detected = listener_detected, listener_id = listener_id)
-                                    else:
-                                        if ((not FileCheck) and FileWrite):
-                                            # Account already exists
-                                            self.returnCode(client = client, code = "IDExists", listener_detected = listener_detected, listener_id = listener_id)
-                                        else:
-                                            # Some other error, raise an internal error.
-                                            self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
+                                    self.accounts.create_account(username, password, ip=ip, callback=lambda *result: self.finishGenAccount(client, username, ip, listener_detected, listener_id, *result))
                                 else:
                                     # Ratelimited
                                     self.returnCode(client = client, code = "RateLimit", listener_detected = listener_detected, listener_id = listener_id)
@@ -397,16 +629,17 @@ class Meower:
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
             if type(val) == str:
-                FileCheck, FileRead, Payload = self.accounts.get_account(val, (val != client), True)
+                # The profile is found whatever case the username is in
+                FileCheck, FileRead, Payload = self.accounts.get_account(val, (val.lower() != client.lower()), True, ignore_case=True)
                 
                 if FileCheck and FileRead:
                     payload = {
                         "mode": "profile",
                         "payload": Payload,
-                        "user_id": val
+                        "user_id": Payload["_id"]
                     }
                     
-                    self.log("{0} fetching profile {1}".format(client, val))
+                    self.log("{0} fetching profile {1}".format(client, Payload["_id"]))
                     self.sendPacket({"cmd": "direct", "val": payload, "id": client}, listener_detected = listener_detected, listener_id = listener_id)
                     
                     # Return to the client it's data
@@ -462,7 +695,11 @@ class Meower:
                 page = int(val["page"])
             else:
                 page = 1
-            home_index = self.getIndex("posts", {"post_origin": "home", "isDeleted": False}, truncate=True, page=page)
+            if (type(val) == dict) and ("cursor" in val) and (type(val["cursor"]) == str):
+                cursor = val["cursor"]
+            else:
+                cursor = None
+            home_index = self.getIndex("posts", {"post_origin": "home", "isDeleted": False}, truncate=True, page=page, cursor=cursor)
             for i in range(len(home_index["index"])):
                 home_index["index"][i] = home_index["index"][i]["_id"]
             payload = {
@@ -509,10 +746,10 @@ class Meower:
             if type(val) == str:
                 result, payload = self.filesystem.load_item("posts", val)
                 if result:
-                    FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+                    FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
                     if FileCheck and FileRead:
                         hasPermission = False
-                        if accountData["lvl"] >= 1:
+                        if userLevel >= 1:
                             hasPermission = True
                         else:
                             if payload["post_origin"] == "home":
@@ -525,7 +762,7 @@ class Meower:
                                     if client in chatdata["members"]:
                                         hasPermission = True
                         if hasPermission:
-                                if payload["isDeleted"] and accountData["lvl"] < 1:
+                                if payload["isDeleted"] and userLevel < 1:
                                     payload = {
                                         "mode": "post",
                                         "payload": {
@@ -591,8 +828,17 @@ class Meower:
                         page = int(val["page"])
                     else:
                         page = 1
+                    if ("cursor" in val) and (type(val["cursor"]) == str):
+                        cursor = val["cursor"]
+                    else:
+                        cursor = None
+
+                    # Posts are stored under the username as it was signed up with
+                    FileCheck, FileRead, username = self.accounts.get_username(val["query"])
+                    if not (FileCheck and FileRead):
+                        username = val["query"]
 
-                    post_index = self.getIndex(location="posts", query={"post_origin": "home", "u": val["query"], "isDeleted": False}, truncate=True, page=page)
+                    post_index = self.getIndex(location="posts", query={"post_origin": "home", "u": username, "isDeleted": False}, truncate=True, page=page, cursor=cursor)
                     for i in range(len(post_index["index"])):
                         post_index["index"][i] = post_index["index"][i]["_id"]
                     post_index["index"].reverse()
@@ -629,7 +875,8 @@ class Meower:
                         else:
                             return self.returnCode(client = client, code = "Syntax", listener_detected = listener_detected, listener_id = listener_id)
                         
-                        if self.filesystem.does_item_exist("reports", val["id"]):
+                        if not self.filesystem.create_item("reports", val["id"], {"type": val["type"], "reports": [client]}):
+                            # Already reported, add the client to the reporters
                             FileRead, reportData = self.filesystem.load_item("reports", val["id"])
                             if FileRead:
                                 if client not in reportData["reports"]:
@@ -644,11 +891,7 @@ class Meower:
                             else:
                                 self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
                         else:
-                            FileWrite = self.filesystem.create_item("reports", val["id"], {"type": val["type"], "reports": [client]})
-                            if FileWrite:
-                                self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
-                            else:
-                                self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
+                            self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
                     else:
                         # Bad datatype
                         self.returnCode(client = client, code = "Datatype", listener_detected = listener_detected, listener_id = listener_id)
@@ -665,9 +908,9 @@ class Meower:
     def close_report(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 1:
+                if userLevel >= 1:
                     if type(val) == str:
                         self.completeReport(val, False)
                         self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
@@ -690,17 +933,16 @@ class Meower:
     def clear_home(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 1:
+                if userLevel >= 1:
                     if (type(val) == dict) and ("page" in val) and self.checkForInt(val["page"]):
                         page = int(val["page"])
                     else:
                         page = 1
                     home_index = self.getIndex("posts", {"post_origin": "home", "isDeleted": False}, truncate=True, page=page)
                     for post in home_index["index"]:
-                        post["isDeleted"] = True
-                        self.filesystem.write_item("posts", post["_id"], post)
+                        self.setPostDeleted(post)
                         self.completeReport(val, None)
                     # Return to the client it's data
                     self.sendPacket({"cmd": "direct", "val": "", "id": client}, listener_detected = listener_detected, listener_id = listener_id)
@@ -722,14 +964,13 @@ class Meower:
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
             if type(val) == str:
-                FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+                FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
                 if FileCheck and FileRead:
-                    if accountData["lvl"] >= 1:
+                    if userLevel >= 1:
                         # Delete all posts
                         post_index = self.getIndex("posts", {"post_origin": "home", "u": str(val), "isDeleted": False}, truncate=False)
                         for post in post_index["index"]:
-                            post["isDeleted"] = True
-                            self.filesystem.write_item("posts", post["_id"], post)
+                            self.setPostDeleted(post)
                             self.completeReport(post["_id"], True)
                             self.sendPacket({"cmd": "direct", "val": {"mode": "delete", "id": post["_id"]}})
                         # Give report feedback
@@ -758,9 +999,9 @@ class Meower:
     def alert(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 1:
+                if userLevel >= 1:
                     if type(val) == dict:
                         if ("username" in val) and ("p" in val):
                             if (type(val["username"]) == str) and (type(val["p"]) == str):
@@ -804,9 +1045,9 @@ class Meower:
     def announce(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 3:
+                if userLevel >= 3:
                     if type(val) == str:
                         self.createPost(post_origin="inbox", user="Server", content=val)
                         self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
@@ -829,25 +1070,34 @@ class Meower:
     def block(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 2:
-                    if type(val) == str:
+                if userLevel >= 2:
+                    if (type(val) == str) and (("/" in val) or ("*" in val)) and (IPBlocklist.parse_network(val) == None):
+                        # Not a range, or a wide enough one to block almost everyone (e.g. "*")
+                        self.returnCode(client = client, code = "Syntax", listener_detected = listener_detected, listener_id = listener_id)
+                    elif type(val) == str:
                         result, payload = self.filesystem.load_item("config", "IPBanlist")
                         if result:
                             if val not in payload["wildcard"]:
                                 self.log("Wildcard unblocking IP address {0}".format(val))
-                                payload["wildcard"].append(val)
                                 self.cl.blockIP(val)
 
                                 # Kick all clients
-                                FileRead, netlog = self.filesystem.load_item("netlog", val)
-                                if FileRead:
-                                    for user in netlog["users"]:
-                                        if user in self.cl.getUsernames() and (self.cl.statedata["ulist"]["objs"][self.cl.statedata["ulist"]["usernames"][user]]["ip"] == val):
+                                if ("/" in val) or ("*" in val):
+                                    # A range can't be looked up in netlog, check everyone online instead
+                                    blocked_range = IPBlocklist([val])
+                                    for user in self.cl.getUsernames():
+                                        if self.cl.getIPofUsername(user) in blocked_range:
                                             self.supporter.kickUser(user, "Blocked")
+                                else:
+                                    FileRead, netlog = self.filesystem.load_item("netlog", val)
+                                    if FileRead:
+                                        for user in netlog["users"]:
+                                            if user in self.cl.getUsernames() and (self.cl.statedata["ulist"]["objs"][self.cl.statedata["ulist"]["usernames"][user]]["ip"] == val):
+                                                self.supporter.kickUser(user, "Blocked")
                                 
-                            result = self.filesystem.write_item("config", "IPBanlist", payload)
+                            result = self.filesystem.modify_item("config", "IPBanlist", add_data={"wildcard": val})
                             if result:
                                 self.sendPacket({"cmd": "direct", "val": "", "id": client}, listener_detected = listener_detected, listener_id = listener_id)
                                 self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
@@ -876,9 +1126,9 @@ class Meower:
     def unblock(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 2:
+                if userLevel >= 2:
                     if type(val) == str:
                         result, payload = self.filesystem.load_item("config", "IPBanlist")
                         if result:
@@ -887,7 +1137,7 @@ class Meower:
                                 payload["wildcard"].remove(val)
                                 self.cl.unblockIP(val)
                                 
-                            result = self.filesystem.write_item("config", "IPBanlist", payload)
+                            result = self.filesystem.modify_item("config", "IPBanlist", pull_data={"wildcard": val})
                             if result:
                                 self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
                             else:
@@ -915,14 +1165,13 @@ class Meower:
     def kick(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 1:
+                if userLevel >= 1:
                     if type(val) == str:
                         if val in self.cl.getUsernames():
                             # Revoke sessions
-                            FileCheck, FileRead, FileWrite = self.accounts.update_setting(val, {"tokens": []}, forceUpdate=True)
-                            if FileCheck and FileRead and FileWrite:
+                            if self.accounts.delete_tokens(val):
                                 # Kick the user
                                 self.supporter.kickUser(val)
                                 
@@ -952,11 +1201,11 @@ class Meower:
     def get_user_ip(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 2:
+                if userLevel >= 2:
                     if type(val) == str:
-                        FileCheck, FileRead, userdata = self.accounts.get_account(val)
+                        FileCheck, FileRead, userdata = self.accounts.get_account(val, fields=["last_ip"])
                         if FileCheck and FileRead:
                             payload = {
                                 "mode": "user_ip",
@@ -993,9 +1242,9 @@ class Meower:
     def get_ip_data(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 2:
+                if userLevel >= 2:
                     if type(val) == str:
                         if self.filesystem.does_item_exist("netlog", str(val)):
                             result, netdata = self.filesystem.load_item("netlog", str(val))
@@ -1038,9 +1287,9 @@ class Meower:
     def get_user_data(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 1:
+                if userLevel >= 1:
                     if type(val) == str:
                         if self.accounts.account_exists(val):
                             FileCheck, FileRead, userdata = self.accounts.get_account(val, False, True)
@@ -1081,9 +1330,9 @@ class Meower:
     def ban(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 1:
+                if userLevel >= 1:
                     if type(val) == str:
                         if self.accounts.account_exists(val):
                             FileCheck, FileRead, FileWrite = self.accounts.update_setting(val, {"banned": True}, forceUpdate=True)
@@ -1124,9 +1373,9 @@ class Meower:
     def pardon(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 1:
+                if userLevel >= 1:
                     if type(val) == str:
                         if self.accounts.account_exists(val):
                             FileCheck, FileRead, FileWrite = self.accounts.update_setting(val, {"banned": False}, forceUpdate=True)
@@ -1162,15 +1411,14 @@ class Meower:
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
             if type(val) == str:
-                FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+                FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
                 if FileCheck and FileRead:
-                    if accountData["lvl"] >= 3:
+                    if userLevel >= 3:
                         if self.filesystem.does_item_exist("usersv0", val):
                             # Delete all posts
                             post_index = self.getIndex("posts", {"u": str(val), "isDeleted": False}, truncate=False)
                             for post in post_index["index"]:
-                                post["isDeleted"] = True
-                                self.filesystem.write_item("posts", post["_id"], post)
+                                self.setPostDeleted(post)
                                 if post["post_origin"] != "inbox":
                                     self.completeReport(post["_id"], True)
                                     self.sendPacket({"cmd": "direct", "val": {"mode": "delete", "id": post["_id"]}})
@@ -1210,9 +1458,9 @@ class Meower:
     def repair_mode(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] >= 4:
+                if userLevel >= 4:
                     self.log("Enabling repair mode")
                     # Save repair mode status to database and memory
                     self.filesystem.write_item("config", "status", {"repair_mode": True, "is_deprecated": False})
@@ -1248,8 +1496,7 @@ class Meower:
                 result, payload = self.filesystem.load_item("posts", val)
                 if result:
                     if (payload["post_origin"] != "inbox") and ((payload["u"] == client) or ((payload["u"] == "Discord") and payload["p"].startswith("{0}:".format(client)))):
-                        payload["isDeleted"] = True
-                        result = self.filesystem.write_item("posts", val, payload)
+                        result = self.setPostDeleted(payload)
                         if result:
                             self.log("{0} deleting post {1}".format(client, val))
 
@@ -1261,12 +1508,11 @@ class Meower:
                         else:
                             self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
                     else:
-                        FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+                        FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
                         if FileCheck and FileRead:
-                            if accountData["lvl"] >= 1:
+                            if userLevel >= 1:
                                 if type(val) == str:
-                                    payload["isDeleted"] = True
-                                    result = self.filesystem.write_item("posts", val, payload)
+                                    result = self.setPostDeleted(payload)
                                     if result:
                                         self.log("{0} deleting post {1}".format(client, val))
 
@@ -1352,8 +1598,7 @@ class Meower:
                                     else:
                                         self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
                                 else:
-                                    payload["members"].remove(client)
-                                    result = self.filesystem.write_item("chats", val, payload)
+                                    result = self.filesystem.modify_item("chats", val, pull_data={"members": client})
                                     if result:
                                         self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
                                     else:
@@ -1576,8 +1821,7 @@ class Meower:
                         if client in chatdata["members"]:
                             # Add user to group chat
                             if (username not in chatdata["members"]) and (username != "Server"):
-                                chatdata["members"].append(username)
-                                FileWrite = self.filesystem.write_item("chats", chatid, chatdata)
+                                FileWrite = self.filesystem.modify_item("chats", chatid, add_data={"members": username})
 
                                 if FileWrite:
                                     # Inbox message to say the user was added to the group chat
@@ -1619,8 +1863,7 @@ class Meower:
                         if client == chatdata["owner"]:
                             if (client != username) and (username != "Server"):
                                 # Remove user from group chat
-                                chatdata["members"].remove(username)
-                                result = self.filesystem.write_item("chats", chatid, chatdata)
+                                result = self.filesystem.modify_item("chats", chatid, pull_data={"members": username})
 
                                 if result:
                                     # Inbox message to say the user was removed from the group chat
@@ -1683,12 +1926,7 @@ class Meower:
                         val = val[:64]
                     
                     # Change password
-                    FileCheck, FileRead, FileWrite = self.accounts.change_password(client, val)
-
-                    if FileCheck and FileRead and FileWrite:
-                        self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
-                    else:
-                        self.returnCode(client = client, code = "Internal", listener_detected = listener_detected, listener_id = listener_id)
+                    self.accounts.change_password(client, val, ip=self.cl.getIPofUsername(client), callback=lambda *result: self.finishChangePswd(client, listener_detected, listener_id, *result))
                 else:
                     self.returnCode(client = client, code = "RateLimit", listener_detected = listener_detected, listener_id = listener_id)
             else:
@@ -1701,10 +1939,9 @@ class Meower:
     def del_tokens(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                FileCheck, FileRead, FileWrite = self.accounts.update_setting(client, {"tokens": []}, forceUpdate=True)
-                if FileCheck and FileRead and FileWrite:
+                if self.accounts.delete_tokens(client):
                     self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
                 else:
                     self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
@@ -1715,39 +1952,32 @@ class Meower:
     def del_account(self, client, val, listener_detected, listener_id):
         # Check if the client is authenticated
         if self.supporter.isAuthenticated(client):
-            FileCheck, FileRead, accountData = self.accounts.get_account(client, True, True)
+            FileCheck, FileRead, userLevel = self.accounts.get_user_level(client)
             if FileCheck and FileRead:
-                if accountData["lvl"] == 0:
-                    all_posts = self.getIndex(location="posts", query={"u": client}, truncate=False)["index"]
-                    for post in all_posts:
-                        self.filesystem.delete_item("posts", post["_id"])
-                        self.completeReport(post["_id"], None)
-                        if post["post_origin"] != "inbox":
-                            self.sendPacket({"cmd": "direct", "val": {"mode": "delete", "id": post["_id"]}})
-                    chat_index = self.getIndex(location="chats", query={"members": {"$all": [client]}}, truncate=False)["index"]
-                    for chat in chat_index:
-                        if chat["owner"] == client:
-                            self.filesystem.delete_item("chats", chat["_id"])
+                if userLevel == 0:
+                    # Only what's needed to tell everyone about the deletion is read, the deletion itself is a few bulk operations
+                    all_posts = list(self.filesystem.db["posts"].find({"u": client}, projection={"_id": 1, "post_origin": 1, "isDeleted": 1}))
+                    owned_chats = list(self.filesystem.db["chats"].find({"owner": client}, projection={"_id": 1, "members": 1}))
+                    FileCheck, FileRead = self.accounts.delete_account(client)
+                    if FileCheck and FileRead:
+                        for post in all_posts:
+                            if not post["isDeleted"]:
+                                self.adjustIndexCount(post["post_origin"], client, -1)
+                            if post["post_origin"] == "home":
+                                self.removeFromHomeBuffer(post["_id"])
+                            if post["post_origin"] != "inbox":
+                                self.sendPacket({"cmd": "direct", "val": {"mode": "delete", "id": post["_id"]}})
+                        for chat in owned_chats:
                             for member in chat["members"]:
                                 if member in self.cl.getUsernames():
                                     self.sendPacket({"cmd": "direct", "val": {"mode": "delete", "id": chat["_id"]}, "id": member})
-                        else:
-                            chat["members"].remove(client)
-                            self.filesystem.write_item("chats", chat["_id"], chat)
-                    netlog_index = self.getIndex(location="netlog", query={"users": {"$all": [client]}}, truncate=False)["index"]
-                    for ip in netlog_index:
-                        ip["users"].remove(client)
-                        if len(ip["users"]) == 0:
-                            self.filesystem.delete_item("netlog", ip["_id"])
-                        else:
-                            if ip["last_user"] == client:
-                                ip["last_user"] = ip["users"][(len(ip["users"])-1)]
-                            self.filesystem.write_item("netlog", ip["_id"], ip)
-                    self.filesystem.delete_item("usersv0", client)
-                    self.completeReport(client, None)
-                    self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
-                    time.sleep(1)
-                    self.cl.kickClient(client)
+                        # Reports on the user and their posts
+                        self.filesystem.db["reports"].delete_many({"_id": {"$in": [post["_id"] for post in all_posts] + [client]}})
+                        self.returnCode(client = client, code = "OK", listener_detected = listener_detected, listener_id = listener_id)
+                        time.sleep(1)
+                        self.cl.kickClient(client)
+                    else:
+                        self.returnCode(client = client, code = "InternalServerError", listener_detected = listener_detected, listener_id = listener_id)
                 else:
                     self.returnCode(client = client, code = "MissingPermissions", listener_detected = listener_detected, listener_id = listener_id)
             else:
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Mongo command count benchmark
+
+Runs the Meower server in-process (without the REST API), connects to it
+over a WebSocket like a client would, and counts the Mongo commands each
+WebSocket command causes. A throwaway account is created for the run and
+deleted at the end with del_account.
+
+Needs a MongoDB server on localhost:27017, the same as main.py.
+
+Usage:
+    python mongo_benchmark.py --save before.json
+    (apply changes)
+    python mongo_benchmark.py --compare before.json
+
+    python mongo_benchmark.py --explain
+    (checks the hot queries use an index and don't sort in memory, exits with 1 if one doesn't)
+"""
+
+import argparse
+import asyncio
+import json
+import secrets
+import sys
+import threading
+import time
+
+from pymongo import monitoring, DESCENDING
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def started(self, event):
+        with self.lock:
+            self.counts[event.command_name] = self.counts.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def snapshot(self):
+        with self.lock:
+            return self.counts.copy()
+
+
+# Must be registered before any MongoClient is created
+counter = CommandCounter()
+monitoring.register(counter)
+
+from cloudlink_loadtest import Client
+from files import Files
+from main import Main
+
+# Query shapes getIndex and friends run, with the sort they use
+NEWEST = [("t.e", DESCENDING)]
+CURSOR = [("t.e", DESCENDING), ("_id", DESCENDING)]
+HOT_QUERIES = [
+    ("home page", "posts", {"post_origin": "home", "isDeleted": False}, NEWEST),
+    ("home cursor", "posts", {"post_origin": "home", "isDeleted": False}, CURSOR),
+    ("chat page", "posts", {"post_origin": "a-chat-id", "isDeleted": False}, NEWEST),
+    ("user posts", "posts", {"post_origin": "home", "u": "someone", "isDeleted": False}, NEWEST),
+    ("user posts cursor", "posts", {"post_origin": "home", "u": "someone", "isDeleted": False}, CURSOR),
+    ("inbox", "posts", {"post_origin": "inbox", "u": {"$in": ["someone", "Server"]}, "isDeleted": False}, NEWEST),
+    ("user's live posts", "posts", {"u": "someone", "isDeleted": False}, None),
+    ("username lookup", "usersv0", {"lower_username": "someone"}, None),
+    ("username search", "usersv0", {"lower_username": {"$regex": "^some"}}, [("lower_username", 1)]),
+    ("user's chats", "chats", {"members": {"$all": ["someone"]}}, None),
+    ("user's IPs", "netlog", {"users": {"$all": ["someone"]}}, None),
+    ("user's sessions", "tokens", {"u": "someone"}, None),
+]
+
+
+def diff_counts(before, after):
+    return {name: after[name] - before.get(name, 0) for name in after if after[name] - before.get(name, 0) > 0}
+
+
+async def run_command(client, cmd, val, listener, settle):
+    before = counter.snapshot()
+    start = time.perf_counter()
+    client.send({"cmd": "direct", "val": {"cmd": cmd, "val": val}, "listener": listener})
+    while True:
+        message = await client.recv()
+        if (message["cmd"] == "statuscode") and (message.get("listener") == listener):
+            break
+    elapsed = time.perf_counter() - start
+
+    # Some commands keep going after replying (e.g. the welcome message on gen_account)
+    await asyncio.sleep(settle)
+    return message["val"], elapsed, diff_counts(before, counter.snapshot())
+
+
+async def run(port, settle):
+    username = "bench_{0}".format(secrets.token_hex(4))
+    password = secrets.token_urlsafe(16)
+    chat_name = "bench chat"
+
+    # The first client signs up, the second one logs in with the password (which kicks the first) and runs the rest
+    clients = []
+    for i in range(2):
+        client = await Client.connect(port)
+        client.send({"cmd": "direct", "val": {"cmd": "ip", "val": "127.0.0.1"}})
+        client.send({"cmd": "direct", "val": {"cmd": "type", "val": "js"}})
+        client.send({"cmd": "direct", "val": "meower"})
+        clients.append(client)
+    await asyncio.sleep(0.5)
+
+    steps = [
+        (0, "gen_account", {"username": username, "pswd": password}),
+        (1, "authpswd", {"username": username, "pswd": password}),
+        (1, "get_profile", username),
+        (1, "update_config", {"quote": "benchmarking"}),
+        (1, "get_home", {"page": 1}),
+        (1, "post_home", "Hello from the Mongo benchmark"),
+        (1, "get_inbox", {"page": 1}),
+        (1, "search_user_posts", {"query": username, "page": 1}),
+        (1, "create_chat", chat_name),
+        (1, "get_chat_list", {"page": 1}),
+        (1, "get_peak_users", ""),
+        (1, "del_tokens", ""),
+        (1, "del_account", ""),
+    ]
+    results = {}
+    for index, (client_index, cmd, val) in enumerate(steps):
+        code, elapsed, counts = await run_command(clients[client_index], cmd, val, "bench-{0}".format(index), settle)
+        results[cmd] = counts
+        print("{0:<20} {1:>4} commands  {2:>8.2f}ms  {3}  {4}".format(
+            cmd,
+            sum(counts.values()),
+            elapsed * 1000,
+            code,
+            ", ".join("{0}: {1}".format(name, count) for name, count in sorted(counts.items()))
+        ))
+
+        # Stay under the per-command rate limits
+        await asyncio.sleep(1.5)
+    for client in clients:
+        client.writer.close()
+    return results
+
+
+def explain():
+    filesystem = Files(print, None)
+    failed = False
+    for name, collection, query, sort in HOT_QUERIES:
+        stages = filesystem.get_query_plan(collection, query, sort)
+        ok = ("COLLSCAN" not in stages) and ("SORT" not in stages)
+        if not ok:
+            failed = True
+        print("{0:<20} {1:<4} {2}".format(name, "OK" if ok else "FAIL", " <- ".join(stages)))
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=3200)
+    parser.add_argument("--settle", type=float, default=0.3, help="seconds to keep counting after each reply")
+    parser.add_argument("--save", help="write the counts to a JSON file")
+    parser.add_argument("--compare", help="compare the counts against a JSON file from --save")
+    parser.add_argument("--explain", action="store_true", help="check the query plans of the hot queries and exit")
+    args = parser.parse_args()
+
+    if args.explain:
+        sys.exit(0 if explain() else 1)
+
+    server = Main()
+    server.supporter.good_ips.append("127.0.0.1") # Skip the IPHub VPN check
+    server.cl.server(ip="127.0.0.1", port=args.port, threaded=True, use_asyncio=True)
+    time.sleep(0.5)
+
+    results = asyncio.run(run(args.port, args.settle))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print()
+        print("{0:<20} {1:>7} {2:>7}".format("command", "before", "after"))
+        for cmd, counts in results.items():
+            print("{0:<20} {1:>7} {2:>7}".format(cmd, sum(previous.get(cmd, {}).values()), sum(counts.values())))
+
+
+if __name__ == "__main__":
+    main()
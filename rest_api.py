@@ -1,33 +1,23 @@
 from flask import Flask, request
 from flask_cors import CORS
-from security import Security
-from supporter import Supporter
-from meower import Meower
-from files import Files
 
 app = Flask(__name__, static_folder="static")
 cors = CORS(app, resources=r'*')
 
-# Init libraries
-supporter = Supporter()
-filesystem = Files(
-    logger = supporter.log,
-    errorhandler = supporter.full_stack
-)
-accounts = Security(
-    files = filesystem,
-    supporter = supporter,
-    logger = supporter.log,
-    errorhandler = supporter.full_stack
-)
-meower = Meower(
-    supporter = supporter,
-    cl = None,
-    logger = supporter.log,
-    errorhandler = supporter.full_stack,
-    accounts = accounts,
-    files = filesystem
-)
+# Set by init, before the app is run
+supporter = None
+filesystem = None
+accounts = None
+meower = None
+
+def init(main_supporter, main_filesystem, main_accounts, main_meower):
+    # Uses the WebSocket server's instances, so a ban, pardon or revoked session drops out of the same auth cache
+    # the REST API checks, and deleted posts leave the same home buffer it reads, instead of separate ones that only expire
+    global supporter, filesystem, accounts, meower
+    supporter = main_supporter
+    filesystem = main_filesystem
+    accounts = main_accounts
+    meower = main_meower
 
 def fetch_post_from_storage(post_id):
     if filesystem.does_item_exist("posts", post_id):
@@ -56,11 +46,10 @@ def pre_request_check_auth():
         token = request.headers.get("token")
         if len(token) > 64:
             username = username[:64]
-        filecheck, fileread, filedata = accounts.get_account(username, False, False)
-        if filecheck and fileread:
-            if (token in filedata["tokens"]) and (filedata["banned"] == False):
-                request.user = filedata["_id"]
-                request.lvl = filedata["lvl"]
+        validauth, banned, lvl = accounts.check_token(username, token)
+        if validauth:
+            request.user = username
+            request.lvl = lvl
 
 @app.route('/', methods = ['GET']) # Index
 def index():
@@ -102,6 +91,7 @@ def get_post():
 @app.route('/posts/<chatid>', methods=["GET"])
 def get_mychat_posts(chatid):
     page = 1
+    cursor = None
     autoget = False
     args = request.args
     
@@ -112,6 +102,9 @@ def get_mychat_posts(chatid):
         except:
             return {"error": True, "type": "Datatype"}, 500
 
+    if "cursor" in args:
+        cursor = args.get("cursor")
+
     if "autoget" in args:
         autoget = True
 
@@ -125,7 +118,7 @@ def get_mychat_posts(chatid):
     else:
         return {"error": True, "type": "notFound"}, 404
 
-    payload = meower.getIndex(location="posts", query={"post_origin": chatid, "isDeleted": False}, truncate=True, page=page)
+    payload = meower.getIndex(location="posts", query={"post_origin": chatid, "isDeleted": False}, truncate=True, page=page, cursor=cursor)
     if not autoget:
         for i in range(len(payload["index"])):
             payload["index"][i] = payload["index"][i]["_id"]
@@ -134,7 +127,10 @@ def get_mychat_posts(chatid):
     else:
         supporter.log("Loaded index, data {0}".format(payload))
         try:
-            tmp_payload = {"error": False, "autoget": [], "page#": payload["page#"], "pages": payload["pages"]}
+            if cursor == None:
+                tmp_payload = {"error": False, "autoget": [], "page#": payload["page#"], "pages": payload["pages"]}
+            else:
+                tmp_payload = {"error": False, "autoget": [], "next": payload["next"]}
             tmp_payload["autoget"] = payload["index"]
             
             return tmp_payload, 200
@@ -144,6 +140,7 @@ def get_mychat_posts(chatid):
 @app.route('/home', methods=["GET"])
 def get_home():
     page = 1
+    cursor = None
     args = request.args
     
     if "page" in args:
@@ -158,9 +155,17 @@ def get_home():
         except:
             return {"error": True, "type": "Datatype"}, 500
 
+    if "cursor" in args:
+        cursor = args.get("cursor")
+        if (cursor != "") and (request.user is None):
+            return {"error": True, "type": "Unauthorized"}, 401
+
     try:
-        posts = meower.getIndex(location="posts", query={"post_origin": "home", "isDeleted": False}, truncate=True, page=page)
-        payload = {"error": False, "autoget": [], "page#": posts["page#"], "pages": (1 if (request.user is None) else posts["pages"])}
+        posts = meower.getIndex(location="posts", query={"post_origin": "home", "isDeleted": False}, truncate=True, page=page, cursor=cursor)
+        if cursor == None:
+            payload = {"error": False, "autoget": [], "page#": posts["page#"], "pages": (1 if (request.user is None) else posts["pages"])}
+        else:
+            payload = {"error": False, "autoget": [], "next": (None if (request.user is None) else posts["next"])}
         payload["autoget"] = posts["index"]
         
         return payload, 200
@@ -209,6 +214,7 @@ def get_reports():
 @app.route('/inbox', methods=["GET"])
 def get_inbox():
     page = 1
+    cursor = None
     autoget = False
     args = request.args
     
@@ -219,13 +225,16 @@ def get_inbox():
         except:
             return {"error": True, "type": "Datatype"}, 500
 
+    if "cursor" in args:
+        cursor = args.get("cursor")
+
     if "autoget" in args:
         autoget = True
 
     if request.user is None:
         return {"error": True, "type": "Unauthorized"}, 401
 
-    payload = meower.getIndex(location="posts", query={"post_origin": "inbox", "u": {"$in": [request.user, "Server"]}, "isDeleted": False}, truncate=True, page=page)
+    payload = meower.getIndex(location="posts", query={"post_origin": "inbox", "u": {"$in": [request.user, "Server"]}, "isDeleted": False}, truncate=True, page=page, cursor=cursor)
     if not autoget:
         for i in range(len(payload["index"])):
             payload["index"][i] = payload["index"][i]["_id"]
@@ -234,7 +243,10 @@ def get_inbox():
     else:
         supporter.log("Loaded index, data {0}".format(payload))
         try:
-            tmp_payload = {"error": False, "autoget": [], "page#": payload["page#"], "pages": payload["pages"]}
+            if cursor == None:
+                tmp_payload = {"error": False, "autoget": [], "page#": payload["page#"], "pages": payload["pages"]}
+            else:
+                tmp_payload = {"error": False, "autoget": [], "next": payload["next"]}
             tmp_payload["autoget"] = payload["index"]
             
             return tmp_payload, 200
@@ -262,10 +274,7 @@ def search_home():
     else:
         return {"error": True, "type": "Syntax"}, 400
 
-    if len(query) > 360:
-        query = query[:360]
-
-    payload = meower.getIndex(location="posts", query={"post_origin": "home", "p": {"$regex": query}, "isDeleted": False}, truncate=True, page=page)
+    payload = meower.searchPosts(query, page=page)
     if not autoget:
         for i in range(len(payload["index"])):
             payload["index"][i] = payload["index"][i]["_id"]
@@ -302,10 +311,7 @@ def search_users():
     else:
         return {"error": True, "type": "Syntax"}, 400
 
-    if len(query) > 20:
-        query = query[:20]
-
-    payload = meower.getIndex(location="usersv0", query={"lower_username": {"$regex": query.lower()}}, truncate=True, page=page, sort="lower_username")
+    payload = meower.searchUsers(query, page=page)
     if not autoget:
         for i in range(len(payload["index"])):
             payload["index"][i] = payload["index"][i]["_id"]
@@ -328,7 +334,7 @@ def search_users():
 
 @app.route('/users/<username>', methods=["GET"])
 def get_user(username):
-    filecheck, fileget, filedata = accounts.get_account(username, True, True)
+    filecheck, fileget, filedata = accounts.get_account(username, True, True, ignore_case=True)
     if filecheck and fileget:
         filedata["error"] = False
         return filedata, 200
@@ -338,6 +344,7 @@ def get_user(username):
 @app.route('/users/<username>/posts', methods=["GET"])
 def get_user_posts(username):
     page = 1
+    cursor = None
     autoget = False
     args = request.args
     
@@ -348,10 +355,17 @@ def get_user_posts(username):
         except:
             return {"error": True, "type": "Datatype"}, 500
     
+    if "cursor" in args:
+        cursor = args.get("cursor")
+
     if "autoget" in args:
         autoget = True
 
-    payload = meower.getIndex(location="posts", query={"post_origin": "home", "u": username, "isDeleted": False}, truncate=True, page=page)
+    filecheck, fileget, canonical_username = accounts.get_username(username)
+    if filecheck and fileget:
+        username = canonical_username
+
+    payload = meower.getIndex(location="posts", query={"post_origin": "home", "u": username, "isDeleted": False}, truncate=True, page=page, cursor=cursor)
     if not autoget:
         for i in range(len(payload["index"])):
             payload["index"][i] = payload["index"][i]["_id"]
@@ -360,7 +374,10 @@ def get_user_posts(username):
     else:
         supporter.log("Loaded index, data {0}".format(payload))
         try:
-            tmp_payload = {"error": False, "autoget": [], "page#": payload["page#"], "pages": payload["pages"]}
+            if cursor == None:
+                tmp_payload = {"error": False, "autoget": [], "page#": payload["page#"], "pages": payload["pages"]}
+            else:
+                tmp_payload = {"error": False, "autoget": [], "next": payload["next"]}
             tmp_payload["autoget"] = payload["index"]
             
             return tmp_payload, 200
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""
+Search benchmark
+
+Fills a separate database with a synthetic corpus of home posts and users,
+with the same indexes as files.py, then times the old $regex searches
+against the text index and username prefix searches that /search/home and
+/search/users use now.
+
+Needs a MongoDB server on localhost:27017, the same as main.py. The corpus
+goes in the meowerbench database, not meowerserver.
+
+Usage:
+    python search_benchmark.py --posts 2000000 --users 200000
+    python search_benchmark.py --reuse (keeps the corpus from the last run)
+"""
+
+import argparse
+import random
+import re
+import time
+
+import pymongo
+
+from files import INDEXES
+
+SEARCHES = ["hello", "meower cat", "scratch project", "zebra", "the"]
+USER_SEARCHES = ["a", "cat", "meow", "zz"]
+
+
+def make_vocabulary(size):
+    random.seed(1)
+    words = ["hello", "meower", "cat", "scratch", "project", "the", "zebra"]
+    while len(words) < size:
+        words.append("".join(random.choice("abcdefghijklmnopqrstuvwxyz") for i in range(random.randint(3, 9))))
+    return words
+
+
+def fill(db, posts, users, batch=10000):
+    db.drop_collection("posts")
+    db.drop_collection("usersv0")
+    for collection in ["posts", "usersv0"]:
+        for index in INDEXES[collection]:
+            if type(index) == tuple:
+                db[collection].create_index(index[0], **index[1])
+            else:
+                db[collection].create_index(index)
+
+    vocabulary = make_vocabulary(50000)
+    # Skewed towards the start of the vocabulary, like real words are
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    start = time.perf_counter()
+    for i in range(0, posts, batch):
+        words = random.choices(vocabulary, weights=weights, k=min(batch, posts - i) * 8)
+        db["posts"].insert_many([{
+            "_id": "post{0}".format(i + j),
+            "type": 1,
+            "post_origin": "home",
+            "u": "user{0}".format(random.randrange(users)),
+            "t": {"e": 1600000000 + i + j},
+            "p": " ".join(words[(j * 8):((j + 1) * 8)]),
+            "isDeleted": False
+        } for j in range(min(batch, posts - i))], ordered=False)
+    usernames = ["{0}{1}".format(random.choice(vocabulary[:200]), i) for i in range(users)]
+    db["usersv0"].insert_many([{"_id": username, "lower_username": username.lower()} for username in usernames], ordered=False)
+    print("Inserted {0} posts and {1} users in {2:.1f}s".format(posts, users, time.perf_counter() - start))
+
+
+def timed(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+
+def run(db, repeat):
+    posts = db["posts"]
+    users = db["usersv0"]
+    print("{0:<20} {1:>14} {2:>14}".format("query", "regex (ms)", "indexed (ms)"))
+    for search in SEARCHES:
+        regex_query = {"post_origin": "home", "p": {"$regex": search}, "isDeleted": False}
+        text_query = {"post_origin": "home", "isDeleted": False, "$text": {"$search": search}}
+        before = timed(lambda: (
+            list(posts.find(regex_query).sort("t.e", pymongo.DESCENDING).limit(25)),
+            posts.count_documents(regex_query)
+        ), repeat)
+        after = timed(lambda: (
+            list(posts.find(text_query, projection={"score": {"$meta": "textScore"}}).sort([("score", {"$meta": "textScore"}), ("t.e", pymongo.DESCENDING)]).limit(25)),
+            posts.count_documents(text_query, limit=250)
+        ), repeat)
+        print("{0:<20} {1:>14.1f} {2:>14.1f}".format("post: " + search, before, after))
+    for search in USER_SEARCHES:
+        substring_query = {"lower_username": {"$regex": search}}
+        prefix_query = {"lower_username": {"$regex": "^{0}".format(re.escape(search))}}
+        before = timed(lambda: (
+            list(users.find(substring_query).limit(25)),
+            users.count_documents(substring_query)
+        ), repeat)
+        after = timed(lambda: (
+            list(users.find(prefix_query, projection={"_id": 1, "lower_username": 1}).sort("lower_username", pymongo.ASCENDING).limit(25)),
+            users.count_documents(prefix_query, limit=250)
+        ), repeat)
+        print("{0:<20} {1:>14.1f} {2:>14.1f}".format("user: " + search, before, after))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=2000000)
+    parser.add_argument("--users", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=5, help="times to run each search, the median is shown")
+    parser.add_argument("--reuse", action="store_true", help="don't refill the corpus")
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient("mongodb://localhost:27017")["meowerbench"]
+    if not args.reuse:
+        fill(db, args.posts, args.users)
+    run(db, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,14 @@
 import bcrypt
+import hashlib
+import multiprocessing
+import os
+import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from pymongo.errors import BulkWriteError
 from uuid import uuid4
 
 """
@@ -7,24 +16,188 @@ Meower Security Module
 This module provides account management and authentication services.
 """
 
+# Run in the hash pool's processes
+def hash_password(password, strength):
+    return bcrypt.hashpw(bytes(password, "utf-8"), bcrypt.gensalt(strength)).decode()
+
+def check_password(password, hashed_pw):
+    # Accounts without a usable hash (e.g. the reserved ones) can't be logged into
+    if get_hash_strength(hashed_pw) == None:
+        return False
+    try:
+        return bcrypt.checkpw(bytes(password, "utf-8"), bytes(hashed_pw, "utf-8"))
+    except ValueError:
+        return False
+
+def get_hash_strength(hashed_pw):
+    # The cost is the second field of a bcrypt hash, e.g. $2b$12$...
+    try:
+        return int(hashed_pw.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def get_pool_context():
+    # Workers are forked from a server process that only has bcrypt and this module loaded, not copies of the
+    # server's state, and they don't each start a fresh interpreter like spawn does
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["bcrypt", "security"])
+        return context
+    else:
+        return multiprocessing.get_context("spawn")
+
+class HashPool:
+    """
+    Runs bcrypt in a pool of processes, so a burst of logins doesn't starve the threads handling packets.
+    Each key (the client's IP) gets its own queue and the queues take turns, so one IP can't fill the pool.
+    """
+
+    def __init__(self, processes=None, max_queued=256, max_queued_per_key=4):
+        self.processes = processes or os.cpu_count() or 1
+        self.max_queued = max_queued
+        self.max_queued_per_key = max_queued_per_key
+        self.executor = None # Started on first use
+        self.lock = threading.Lock()
+        self.queues = OrderedDict()
+        self.queued = 0
+        self.running = 0
+        self.stats = {
+            "processed": 0,
+            "rejected": 0
+        }
+    
+    def submit(self, key, function, *args):
+        """
+        Queues function(*args) to run in the pool.
+        Returns False and None if the pool is too backed up to take it, otherwise True and a Future for the result.
+        """
+        
+        future = Future()
+        with self.lock:
+            if (self.queued >= self.max_queued) or (len(self.queues.get(key, ())) >= self.max_queued_per_key):
+                self.stats["rejected"] += 1
+                return False, None
+            if not key in self.queues:
+                self.queues[key] = deque()
+            self.queues[key].append((function, args, future))
+            self.queued += 1
+            started = self._dispatch()
+        self._watch(started)
+        return True, future
+    
+    def run(self, key, function, *args):
+        """
+        Runs function(*args) in the pool and waits for it.
+        Returns False and None if the pool is too backed up to take it, otherwise True and the result.
+        """
+        
+        queued, future = self.submit(key, function, *args)
+        if not queued:
+            return False, None
+        return True, future.result()
+    
+    def get_stats(self):
+        with self.lock:
+            stats = self.stats.copy()
+            stats["queued"] = self.queued
+            stats["running"] = self.running
+        return stats
+    
+    def _dispatch(self):
+        # Called with the lock held, hands tasks to idle processes taking one from each key in turn
+        # Returns them for _watch, which has to be called once the lock is released
+        started = []
+        while (self.running < self.processes) and (len(self.queues) > 0):
+            if self.executor == None:
+                self.executor = ProcessPoolExecutor(self.processes, mp_context=get_pool_context())
+            key, tasks = next(iter(self.queues.items()))
+            function, args, future = tasks.popleft()
+            if len(tasks) == 0:
+                del self.queues[key]
+            else:
+                self.queues.move_to_end(key)
+            self.queued -= 1
+            self.running += 1
+            try:
+                started.append((self.executor.submit(function, *args), future, self.executor))
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    self._replace(self.executor)
+                self.running -= 1
+                started.append((e, future, None))
+        return started
+    
+    def _replace(self, executor):
+        # Called with the lock held. Once a process dies (e.g. killed for memory) the executor refuses every task,
+        # so it's dropped and the next task starts a new one
+        if self.executor is executor:
+            self.executor = None
+            executor.shutdown(wait=False)
+    
+    def _watch(self, started):
+        # A task that's already done runs its callback straight away, so this can't be done with the lock held
+        for result, future, executor in started:
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                result.add_done_callback(lambda result, future=future, executor=executor: self._done(result, future, executor))
+    
+    def _done(self, result, future, executor):
+        with self.lock:
+            self.running -= 1
+            self.stats["processed"] += 1
+            if isinstance(result.exception(), BrokenProcessPool):
+                self._replace(executor)
+            started = self._dispatch()
+        self._watch(started)
+        if result.exception() != None:
+            future.set_exception(result.exception())
+        else:
+            future.set_result(result.result())
+
 class Security:
-    def __init__(self, files, supporter, logger, errorhandler):
+    def __init__(self, files, supporter, logger, errorhandler, auth_cache_size=10000, auth_cache_ttl=30, hash_processes=None, token_ttl=(60*60*24*30), hash_strength=12, workers=None):
         self.bc = bcrypt
+        self.hash_pool = HashPool(processes=hash_processes)
+        self.workers = workers # CloudLink's WorkerPool, finishes password work for callers that pass a callback
+        self.hash_strength = hash_strength # bcrypt cost of new hashes, older hashes are redone when their owner logs in
+        self.token_ttl = token_ttl # Seconds a session lasts after it was last used
         self.supporter = supporter
         self.files = files
         self.log = logger
         self.errorhandler = errorhandler
+
+        # Level, ban state and checked token hashes of recently seen accounts, so permission checks don't need the database.
+        # Entries are dropped whenever they change. The REST API shares this instance, the TTL only matters for changes
+        # made straight to the database.
+        self.auth_cache = OrderedDict()
+        self.auth_cache_size = auth_cache_size
+        self.auth_cache_ttl = auth_cache_ttl
+        self.auth_cache_lock = threading.Lock()
+        self.auth_cache_stats = {
+            "hits": 0,
+            "misses": 0,
+            "invalidations": 0
+        }
+        
+        # Usernames as they were signed up with, by lowercase username. Usernames never change, so entries only go stale
+        # when an account is deleted, and are dropped then.
+        self.username_cache = OrderedDict()
+        
+        self.migrate_tokens()
         self.log("Security initialized!")
     
-    def create_account(self, username, password, strength=12):
+    def create_account(self, username, password, strength=None, ip=None, callback=None):
     
         """
         Returns 2 booleans.
+        With a callback, returns nothing and calls it with them instead, see _after_hash.
         
         | FileCheck | FileWrite | Definiton
         |---------|----------|-----------------
         |  True  |   True   | Account created
         |  True  |   False  | Account creation error
+        |  True  |   None   | Hash pool too busy, try again later
         |  False |   True   | Account already exists
         |  False |   False  | Exception
         """
@@ -32,39 +205,79 @@ class Security:
         if (type(password) == str) and (type(username) == str):
             if not self.account_exists(str(username), ignore_case=True):
                 self.log("Creating account: {0}".format(username))
-                pswd_bytes = bytes(password, "utf-8") # Convert password to bytes
-                hashed_pw = self.bc.hashpw(pswd_bytes, self.bc.gensalt(strength)) # Hash and salt the password
-                result = self.files.create_item("usersv0", str(username), { # Default account data
-                        "lower_username": username.lower(),
-                        "created": int(time.time()),
-                        "uuid": str(uuid4()),
-                        "unread_inbox": False,
-                        "theme": "orange",
-                        "mode": True,
-                        "sfx": True,
-                        "debug": False,
-                        "bgm": True,
-                        "bgm_song": 2,
-                        "layout": "new",
-                        "pfp_data": 1,
-                        "quote": "",
-                        "email": "",
-                        "pswd": hashed_pw.decode(),
-                        "tokens": [],
-                        "lvl": 0,
-                        "banned": False,
-                        "last_ip": None
-                    }
-                )
-                return True, result
+                try:
+                    queued, future = self.hash_pool.submit(ip, hash_password, password, strength or self.hash_strength) # Hash and salt the password
+                except Exception as e:
+                    self.log("Error on generate_account: {0}".format(e))
+                    return self._reply(callback, (True, False))
+                if not queued:
+                    return self._reply(callback, (True, None))
+                return self._after_hash(ip, future, callback, self._finish_create_account, str(username))
             else:
                 self.log("Not creating account {0}: Account already exists".format(username))
-                return False, True
+                return self._reply(callback, (False, True))
         else:
             self.log("Error on generate_account: Expected str for username and password, got {0} for username and {1} for password".format(type(username), type(password)))
-            return False, False
+            return self._reply(callback, (False, False))
+    
+    def _finish_create_account(self, future, username):
+        try:
+            hashed_pw = future.result()
+        except Exception as e:
+            self.log("Error on generate_account: {0}".format(e))
+            return True, False
+        result = self.files.create_item("usersv0", str(username), { # Default account data
+                "lower_username": username.lower(),
+                "created": int(time.time()),
+                "uuid": str(uuid4()),
+                "unread_inbox": False,
+                "theme": "orange",
+                "mode": True,
+                "sfx": True,
+                "debug": False,
+                "bgm": True,
+                "bgm_song": 2,
+                "layout": "new",
+                "pfp_data": 1,
+                "quote": "",
+                "email": "",
+                "pswd": hashed_pw,
+                "lvl": 0,
+                "banned": False,
+                "last_ip": None
+            }
+        )
+        if result:
+            return True, True
+        else:
+            # The insert only fails on a duplicate _id or lower_username, someone signed up with the same name first
+            self.log("Not creating account {0}: Account already exists".format(username))
+            return False, True
+    
+    def _reply(self, callback, result):
+        # Returns a method's result, or passes it to the callback the method was given
+        if callback == None:
+            return result
+        callback(*result)
     
-    def get_account(self, username, omitSensitive=False, isClient=False):
+    def _after_hash(self, key, future, callback, finish, *args):
+        """
+        Finishes a method once the hash pool is done, finish(future, *args) returns the method's result.
+        Without a callback, this waits for the pool and returns the result.
+        With one, nothing waits: finish and the callback run on a CloudLink worker (keyed by key, the client's IP)
+        once the pool is done, so a burst of logins can't park every packet worker on bcrypt.
+        """
+        
+        if callback == None:
+            return finish(future, *args)
+        def done(future):
+            if self.workers == None:
+                callback(*finish(future, *args))
+            else:
+                self.workers.submit(key, lambda: callback(*finish(future, *args)), force=True)
+        future.add_done_callback(done)
+    
+    def get_account(self, username, omitSensitive=False, isClient=False, fields=None, ignore_case=False):
         """
         Returns 2 booleans, plus a payload.
         
@@ -74,101 +287,268 @@ class Security:
         |  True   |   False  | Account exists, read error
         |  False  |   True   | Account does not exist
         |  False  |   False  | Exception
+
+        Only the keys in fields are read when it's given, so callers that need
+        one or two keys don't transfer the whole account.
+        With ignore_case, the account is found by its lowercase username, and
+        its "_id" is the username as it was signed up with.
         """
         
         if type(username) == str:
-            if self.files.does_item_exist("usersv0", str(username)):
+            hidden = []
+            if omitSensitive: # Purge sensitive data and remove user settings
+                hidden.extend([
+                    "unread_inbox",
+                    "theme",
+                    "mode",
+                    "sfx",
+                    "debug",
+                    "bgm",
+                    "bgm_song",
+                    "layout",
+                    "email",
+                    "pswd",
+                    "tokens",
+                    "last_ip"
+                ])
+            if isClient:
+                hidden.extend(["pswd", "tokens", "last_ip"])
+            
+            # Hidden keys are left out by the database, instead of being deleted after they're read
+            if fields != None:
+                projection = {"_id": 1}
+                for key in fields:
+                    if not key in hidden:
+                        projection[key] = 1
+            elif len(hidden) > 0:
+                projection = {key: 0 for key in hidden}
+            else:
+                projection = None
+            
+            if ignore_case:
+                result, accountData = self.files.find_item("usersv0", {"lower_username": str(username).lower()}, projection=projection)
+            else:
+                result, accountData = self.files.load_item("usersv0", str(username), projection=projection)
+            if result:
                 self.log("Reading account: {0}".format(username))
-                result, accountData = self.files.load_item("usersv0", str(username))
-                
-                if omitSensitive: # Purge sensitive data and remove user settings
-                    for sensitive in [
-                        "unread_inbox",
-                        "theme",
-                        "mode",
-                        "sfx",
-                        "debug",
-                        "bgm",
-                        "bgm_song",
-                        "layout",
-                        "email",
-                        "pswd",
-                        "tokens",
-                        "last_ip"
-                    ]:
-                        if sensitive in accountData:
-                            del accountData[sensitive]
-                
-                if isClient:
-                    if "pswd" in accountData:
-                        del accountData["pswd"]
-                    if "tokens" in accountData:
-                        del accountData["tokens"]
-                    if "last_ip" in accountData:
-                        del accountData["last_ip"]
-                
-                return True, result, accountData
+                return True, True, accountData
             else:
                 return False, True, None
         else:
             self.log("Error on get_account: Expected str for username, got {0}".format(type(username)))
             return False, False, None
     
-    def authenticate(self, username, password): 
+    def hash_token(self, token):
+        return hashlib.sha256(bytes(token, "utf-8")).hexdigest()
+    
+    def get_auth_state(self, username):
+        """
+        Returns 2 booleans, plus the cached auth state of the account.
+        The auth state is a dict with "lvl", "banned" and "tokens" (a set of token hashes check_token has found valid).
+        
+        | FileCheck | FileRead | Definiton
+        |---------|----------|-----------------
+        |  True   |   True   | Account exists and read 
+        |  False  |   True   | Account does not exist
+        |  False  |   False  | Exception
+        """
+        
+        if type(username) != str:
+            self.log("Error on get_auth_state: Expected str for username, got {0}".format(type(username)))
+            return False, False, None
+        
+        with self.auth_cache_lock:
+            if username in self.auth_cache:
+                state = self.auth_cache[username]
+                if time.monotonic() < state["expires"]:
+                    self.auth_cache.move_to_end(username)
+                    self.auth_cache_stats["hits"] += 1
+                    return True, True, state
+                del self.auth_cache[username]
+            self.auth_cache_stats["misses"] += 1
+        
+        FileCheck, FileRead, accountData = self.get_account(username, fields=["lvl", "banned"])
+        if not (FileCheck and FileRead):
+            return FileCheck, FileRead, None
+        
+        state = {
+            "lvl": accountData["lvl"],
+            "banned": accountData["banned"],
+            "tokens": set(),
+            "expires": time.monotonic() + self.auth_cache_ttl
+        }
+        with self.auth_cache_lock:
+            self.auth_cache[username] = state
+            self.auth_cache.move_to_end(username)
+            while len(self.auth_cache) > self.auth_cache_size:
+                self.auth_cache.popitem(last=False)
+        return True, True, state
+    
+    def invalidate_auth_state(self, username):
+        with self.auth_cache_lock:
+            if username in self.auth_cache:
+                del self.auth_cache[username]
+                self.auth_cache_stats["invalidations"] += 1
+    
+    def get_auth_cache_stats(self):
+        with self.auth_cache_lock:
+            stats = self.auth_cache_stats.copy()
+            stats["size"] = len(self.auth_cache)
+        lookups = stats["hits"] + stats["misses"]
+        if lookups > 0:
+            stats["hit_rate"] = stats["hits"] / lookups
+        else:
+            stats["hit_rate"] = 0
+        return stats
+    
+    def get_user_level(self, username):
+        """
+        Returns 2 booleans, plus the account level.
+        
+        | FileCheck | FileRead | Definiton
+        |---------|----------|-----------------
+        |  True   |   True   | Account exists and read 
+        |  False  |   True   | Account does not exist
+        |  False  |   False  | Exception
+        """
+        
+        FileCheck, FileRead, state = self.get_auth_state(username)
+        if FileCheck and FileRead:
+            return True, True, state["lvl"]
+        else:
+            return FileCheck, FileRead, None
+    
+    def check_token(self, username, token):
+        """
+        Returns 2 booleans, plus the account level.
+        Checks a token without using it up, for clients that send it with every request.
+        
+        | ValidAuth | Banned | Definiton
+        |---------|----------|-----------------
+        |  True   |  False   | Token valid
+        |  False  |  True    | Account banned
+        |  False  |  False   | Token invalid or account does not exist
+        """
+        
+        FileCheck, FileRead, state = self.get_auth_state(username)
+        if not (FileCheck and FileRead) or (type(token) != str):
+            return False, False, None
+        if state["banned"]:
+            return False, True, state["lvl"]
+        token_hash = self.hash_token(token)
+        if token_hash in state["tokens"]:
+            return True, False, state["lvl"]
+        
+        # Validates and keeps the session alive in one round trip
+        now = datetime.now(timezone.utc)
+        session = self.files.db["tokens"].find_one_and_update(
+            {"_id": token_hash, "u": username, "expires": {"$gt": now}},
+            {"$set": {"last_used": int(time.time()), "expires": now + timedelta(seconds=self.token_ttl)}},
+            projection={"_id": 1}
+        )
+        if session != None:
+            with self.auth_cache_lock:
+                state["tokens"].add(token_hash)
+            return True, False, state["lvl"]
+        else:
+            return False, False, None
+    
+    def authenticate(self, username, password, ip=None, callback=None): 
         """
         Returns 3 booleans.
+        With a callback, returns nothing and calls it with them instead, see _after_hash.
         
         | FileCheck | FileRead | ValidAuth | Definiton
         |---------|----------|----------|-----------------
         |  True   |   True   |  True    | Account exists, read OK, authentication valid
         |  True   |   True   |  False   | Account exists, read OK, authentication invalid
-        |  True   |   False  |  False   | Account exists, read error
+        |  True   |   True   |  None    | Account exists, read OK, hash pool too busy to check the password
+        |  True   |   False  |  False   | Account exists, read error or the password couldn't be checked
         |  False  |   True   |  False   | Account does not exist
         |  False  |   False  |  False   | Exception
         """
         
         if type(username) == str:
-            if self.files.does_item_exist("usersv0", str(username)):
+            FileCheck, accountData = self.files.load_item("usersv0", str(username), projection={"banned": 1, "pswd": 1})
+            if FileCheck:
                 self.log("Authenticating account: {0}".format(username))
-                FileRead, accountData = self.files.load_item("usersv0", str(username))
-                if FileRead:
-                    if type(accountData) == dict:
-                        if accountData["banned"] == True:
-                            return True, True, False, True
-                        if password in accountData["tokens"]:
-                            self.log("Authenticating {0}: True".format(username))
-                            accountData["tokens"].remove(password)
-                            self.update_setting(username, {"tokens": accountData["tokens"]}, forceUpdate=True)
-                            return True, True, True, False
-                        else:
-                            hashed_pw = accountData["pswd"]
-                            pswd_bytes = bytes(password, "utf-8")
-                            hashed_pw_bytes = bytes(hashed_pw, "utf-8")
-                            try:
-                                result = self.bc.checkpw(pswd_bytes, hashed_pw_bytes)
-                                self.log("Authenticating {0}: {1}".format(username, result))
-                                return True, True, result, False
-                            except Exception as e:
-                                self.log("Error on authenticate: {0}".format(e))
-                                return True, True, False, False
+                if type(accountData) == dict:
+                    if accountData["banned"] == True:
+                        return self._reply(callback, (True, True, False, True))
+                    if (type(password) == str) and self.use_token(str(username), password):
+                        self.log("Authenticating {0}: True".format(username))
+                        return self._reply(callback, (True, True, True, False))
                     else:
-                        self.log("Error on get_account: Expected str for username, got {0}".format(type(username)))
-                        return False, False, False, False
+                        try:
+                            queued, future = self.hash_pool.submit(ip, check_password, password, accountData["pswd"])
+                        except Exception as e:
+                            self.log("Error on authenticate: {0}".format(e))
+                            return self._reply(callback, (True, False, False, False))
+                        if not queued:
+                            self.log("Authenticating {0}: hash pool busy".format(username))
+                            return self._reply(callback, (True, True, None, False))
+                        return self._after_hash(ip, future, callback, self._finish_authenticate, str(username), password, accountData["pswd"], ip)
                 else:
-                    return True, False, False, False
+                    return self._reply(callback, (True, False, False, False))
             else:
-                return False, True, False, False
+                return self._reply(callback, (False, True, False, False))
         else:
             self.log("Error on get_account: Expected str for username, got {0}".format(type(username)))
-            return False, False, False, False
+            return self._reply(callback, (False, False, False, False))
     
-    def change_password(self, username, newpassword, strength=12):
+    def _finish_authenticate(self, future, username, password, hashed_pw, ip):
+        try:
+            result = future.result()
+        except Exception as e:
+            self.log("Error on authenticate: {0}".format(e))
+            return True, False, False, False
+        self.log("Authenticating {0}: {1}".format(username, result))
+        if result and (get_hash_strength(hashed_pw) != self.hash_strength):
+            # Queued behind the login, which doesn't wait for it
+            self.rehash_password(username, password, hashed_pw, ip)
+        return True, True, result, False
+    
+    def rehash_password(self, username, password, old_hash, ip=None):
+        """
+        Returns a boolean.
+        Queues hashing a password again with the current hash strength, after a successful login with it.
+        The hash is replaced once the pool is done, on a CloudLink worker when there is one (see _after_hash).
+        
+        | Queued | Definiton
+        |---------|-----------------
+        |  True   | Hash will be replaced, unless the password is changed meanwhile
+        |  False  | Hash pool busy or exception, tried again on their next login
+        """
+        
+        try:
+            queued, future = self.hash_pool.submit(ip, hash_password, password, self.hash_strength)
+        except Exception as e:
+            self.log("Error on rehash_password: {0}".format(e))
+            return False
+        if not queued:
+            return False
+        self._after_hash(ip, future, lambda result: None, self._finish_rehash_password, username, old_hash) # Nothing waits on the result
+        return True
+    
+    def _finish_rehash_password(self, future, username, old_hash):
+        try:
+            # Only replaces the hash that was checked, in case the password was changed meanwhile
+            result = self.files.db["usersv0"].update_one({"_id": username, "pswd": old_hash}, {"$set": {"pswd": future.result()}}).matched_count > 0
+            self.log("Rehashing {0} password from strength {1} to {2}: {3}".format(username, get_hash_strength(old_hash), self.hash_strength, result))
+        except Exception as e:
+            self.log("Error on rehash_password: {0}".format(e))
+            result = False
+        return result,
+    
+    def change_password(self, username, newpassword, strength=None, ip=None, callback=None):
         """
         Returns 3 booleans.
+        With a callback, returns nothing and calls it with them instead, see _after_hash.
         
         | FileCheck | FileRead | FileWrite | Definiton
         |---------|----------|----------|-----------------
         |  True   |   True   |  True    | Account exists, read OK, password changed
+        |  True   |   True   |  None    | Account exists, hash pool too busy, try again later
         |  True   |   False  |  False   | Account exists, read error
         |  False  |   True   |  False   | Account does not exist
         |  False  |   False  |  False   | Exception
@@ -177,42 +557,77 @@ class Security:
         if (type(username) == str) and (type(newpassword) == str):
             if self.files.does_item_exist("usersv0", str(username)):
                 self.log("Changing {0} password".format(username))
-                result, accountData = self.files.load_item("usersv0", str(username))
-                if result:
-                    try:
-                        pswd_bytes = bytes(newpassword, "utf-8") # Convert password to bytes
-                        hashed_pw = self.bc.hashpw(pswd_bytes, self.bc.gensalt(strength)) # Hash and salt the password
-                        
-                        accountData["pswd"] = hashed_pw.decode()
-                        
-                        result = self.files.write_item("usersv0", str(username), accountData)
-                        self.log("Change {0} password: {1}".format(username, result))
-                        return True, True, result
-                    except Exception as e:
-                        self.log("Error on authenticate: {0}".format(e))
-                        return True, True, False
-                else:
-                    return True, False, False
+                try:
+                    queued, future = self.hash_pool.submit(ip, hash_password, newpassword, strength or self.hash_strength) # Hash and salt the password
+                except Exception as e:
+                    self.log("Error on change_password: {0}".format(e))
+                    return self._reply(callback, (True, True, False))
+                if not queued:
+                    return self._reply(callback, (True, True, None))
+                return self._after_hash(ip, future, callback, self._finish_change_password, str(username))
             else:
-                return False, True, False
+                return self._reply(callback, (False, True, False))
         else:
             self.log("Error on get_account: Expected str for username, oldpassword and newpassword, got {0} for username and {1} for newpassword".format(type(username), type(newpassword)))
-            return False, False, False
+            return self._reply(callback, (False, False, False))
+    
+    def _finish_change_password(self, future, username):
+        try:
+            hashed_pw = future.result()
+        except Exception as e:
+            self.log("Error on change_password: {0}".format(e))
+            return True, True, False
+        
+        # Only the hash is written, so nothing else in the account gets overwritten
+        result = self.files.update_item("usersv0", str(username), {"pswd": hashed_pw})
+        self.log("Change {0} password: {1}".format(username, result))
+        return True, True, result
     
     def account_exists(self, username, ignore_case=False):
         if type(username) == str:
             if ignore_case:
-                payload = self.files.find_items("usersv0", {"lower_username": str(username).lower()})
-                if len(payload) == 0:
-                    return False
-                else:
-                    return True
+                result, payload = self.files.find_item("usersv0", {"lower_username": str(username).lower()}, projection={"_id": 1})
+                return result
             else:
                 return self.files.does_item_exist("usersv0", str(username))
         else:
             self.log("Error on account_exists: Expected str for username, got {0}".format(type(username)))
             return False
     
+    def get_username(self, username):
+        """
+        Returns 2 booleans, plus the username as it was signed up with, for a username in any case.
+        
+        | FileCheck | FileRead | Definiton
+        |---------|----------|-----------------
+        |  True   |   True   | Account exists and read 
+        |  False  |   True   | Account does not exist
+        |  False  |   False  | Exception
+        """
+        
+        if type(username) == str:
+            lower_username = username.lower()
+            with self.auth_cache_lock:
+                if lower_username in self.username_cache:
+                    canonical_username, expires = self.username_cache[lower_username]
+                    if time.monotonic() < expires:
+                        self.username_cache.move_to_end(lower_username)
+                        return True, True, canonical_username
+                    del self.username_cache[lower_username]
+            
+            result, payload = self.files.find_item("usersv0", {"lower_username": lower_username}, projection={"_id": 1})
+            if result:
+                with self.auth_cache_lock:
+                    self.username_cache[lower_username] = (payload["_id"], time.monotonic() + self.auth_cache_ttl)
+                    while len(self.username_cache) > self.auth_cache_size:
+                        self.username_cache.popitem(last=False)
+                return True, True, payload["_id"]
+            else:
+                return False, True, None
+        else:
+            self.log("Error on get_username: Expected str for username, got {0}".format(type(username)))
+            return False, False, None
+    
     def is_account_banned(self, username):
         """
         Returns 2 booleans, plus a payload.
@@ -227,10 +642,9 @@ class Security:
         """
         
         if type(username) == str:
-            if self.files.does_item_exist("usersv0", str(username)):
-                self.log("Reading account: {0}".format(username))
-                result, accountData = self.files.load_item("usersv0", str(username))
-                return True, result, accountData["banned"]
+            FileCheck, FileRead, state = self.get_auth_state(str(username))
+            if FileCheck and FileRead:
+                return True, True, state["banned"]
             else:
                 return False, True, None
         else:
@@ -251,73 +665,182 @@ class Security:
         """
         
         if (type(username) == str) and (type(newdata) == dict):
-            if self.files.does_item_exist("usersv0", str(username)):
+            # Only the keys being changed are read, the rest of the account isn't needed
+            projection = {"_id": 1}
+            for key in newdata.keys():
+                if (type(key) == str) and (not "." in key) and (not key.startswith("$")):
+                    projection[key] = 1
+            result, accountData = self.files.load_item("usersv0", str(username), projection=projection)
+            if result:
                 self.log("Updating account settings: {0}".format(username))
-                result, accountData = self.files.load_item("usersv0", str(username))
-                if result:
-                    for key, value in newdata.items():
-                        if key in accountData.keys():
-                            if forceUpdate:
-                                accountData[key] = value
+                # Only the changed keys are written, so concurrent updates to other keys aren't clobbered
+                changes = {}
+                for key, value in newdata.items():
+                    if key in accountData.keys():
+                        if forceUpdate:
+                            changes[key] = value
+                        else:
+                            if key not in ["lvl", "pswd", "banned", "email", "last_ip", "lower_username", "uuid", "tokens", "created", "_id"]:
+                                if key in accountData.keys():
+                                    if ((type(value) == str) and (len(value) <= 360)) or ((type(value) == int) and (len(str(value)) <= 360)) or ((type(value) == float) and (len(str(value)) <= 360)) or (type(value) == bool) or (type(value) == None):
+                                        if type(value) == str:
+                                            changes[key] = self.supporter.wordfilter(value)
+                                        else:
+                                            changes[key] = value
                             else:
-                                if key not in ["lvl", "pswd", "banned", "email", "last_ip", "lower_username", "uuid", "tokens", "created"]:
-                                    if key in accountData.keys():
-                                        if ((type(value) == str) and (len(value) <= 360)) or ((type(value) == int) and (len(str(value)) <= 360)) or ((type(value) == float) and (len(str(value)) <= 360)) or (type(value) == bool) or (type(value) == None):
-                                            if type(value) == str:
-                                                accountData[key] = self.supporter.wordfilter(value)
-                                            else:
-                                                accountData[key] = value
-                                else:
-                                    self.log("Blocking attempt to modify secure key {0}".format(key))
-                    
-                    result = self.files.write_item("usersv0", str(username), accountData)
-                    self.log("Updating {0} account settings: {1}".format(username, result))
-                    return True, True, result
-                else:
-                    return True, False, False
+                                self.log("Blocking attempt to modify secure key {0}".format(key))
+                
+                result = self.files.modify_item("usersv0", str(username), set_data=changes)
+                if forceUpdate:
+                    self.invalidate_auth_state(str(username))
+                self.log("Updating {0} account settings: {1}".format(username, result))
+                return True, True, result
             else:
                 return False, True, False
         else:
             self.log("Error on get_account: Expected str for username and dict for newdata, got {0} for username and {1} for newdata".format(type(username), type(newdata)))
             return False, False, False
 
+    def migrate_tokens(self):
+        # Sessions used to be raw tokens in an array on the account. They're moved into the tokens collection as hashes,
+        # so nobody is logged out, and then removed from the account.
+        migrated = 0
+        for accountData in self.files.db["usersv0"].find({"tokens": {"$exists": True}}, projection={"tokens": 1}):
+            if type(accountData["tokens"]) == list:
+                now = int(time.time())
+                sessions = []
+                for token in set(accountData["tokens"]):
+                    if type(token) == str:
+                        sessions.append({
+                            "_id": self.hash_token(token),
+                            "u": accountData["_id"],
+                            "created": now,
+                            "last_used": now,
+                            "expires": datetime.now(timezone.utc) + timedelta(seconds=self.token_ttl)
+                        })
+                if len(sessions) > 0:
+                    try:
+                        self.files.db["tokens"].insert_many(sessions, ordered=False)
+                    except BulkWriteError:
+                        pass # Moved already by an earlier run that stopped before removing the array
+            self.files.db["usersv0"].update_one({"_id": accountData["_id"]}, {"$unset": {"tokens": ""}})
+            migrated += 1
+        if migrated > 0:
+            self.log("Moved old tokens of {0} accounts to the tokens collection".format(migrated))
+    
+    def add_token(self, username, token, last_ip):
+        """
+        Returns a boolean.
+        Only the token's hash is stored, in the tokens collection.
+        
+        | FileWrite | Definiton
+        |---------|-----------------
+        |  True   | Token added and last IP set
+        |  False  | Account does not exist, or exception
+        """
+        
+        if (type(username) == str) and (type(token) == str):
+            if not self.files.modify_item("usersv0", str(username), set_data={"last_ip": last_ip}):
+                return False
+            try:
+                self.files.db["tokens"].insert_one({
+                    "_id": self.hash_token(token),
+                    "u": username,
+                    "created": int(time.time()),
+                    "last_used": int(time.time()),
+                    "expires": datetime.now(timezone.utc) + timedelta(seconds=self.token_ttl)
+                })
+                return True
+            except Exception as e:
+                self.log("Error on add_token: {0}".format(e))
+                return False
+        else:
+            self.log("Error on add_token: Expected str for username and token, got {0} for username and {1} for token".format(type(username), type(token)))
+            return False
+    
+    def use_token(self, username, token):
+        """
+        Returns a boolean.
+        Deletes the token, so it can only be used to log in once.
+        
+        | ValidAuth | Definiton
+        |---------|-----------------
+        |  True   | Token was valid and is now used up
+        |  False  | Token invalid or expired
+        """
+        
+        token_hash = self.hash_token(token)
+        session = self.files.db["tokens"].find_one_and_delete(
+            {"_id": token_hash, "u": username, "expires": {"$gt": datetime.now(timezone.utc)}},
+            projection={"_id": 1}
+        )
+        if session != None:
+            with self.auth_cache_lock:
+                if username in self.auth_cache:
+                    self.auth_cache[username]["tokens"].discard(token_hash)
+            return True
+        else:
+            return False
+    
+    def delete_tokens(self, username):
+        """
+        Returns a boolean.
+        Revokes every session of the account.
+        
+        | FileWrite | Definiton
+        |---------|-----------------
+        |  True   | Tokens deleted (or there were none)
+        |  False  | Exception
+        """
+        
+        if type(username) == str:
+            try:
+                self.files.db["tokens"].delete_many({"u": username})
+            except Exception as e:
+                self.log("Error on delete_tokens: {0}".format(e))
+                return False
+            self.invalidate_auth_state(str(username))
+            self.log("Deleted {0} tokens".format(username))
+            return True
+        else:
+            self.log("Error on delete_tokens: Expected str for username, got {0}".format(type(username)))
+            return False
+
     def delete_account(self, username):
         """
         Returns 2 booleans.
+        Everything is removed with a few bulk operations, not one per chat or IP.
         
         | FileCheck | FileRead | Definiton
         |---------|----------|-----------------
-        |  True   |   True   | Account exists and read 
-        |  True   |   False  | Account exists, read error
+        |  True   |   True   | Account deleted
         |  False  |   True   | Account does not exist
         |  False  |   False  | Exception
         """
 
         if type(username) == str:
-            if self.files.does_item_exist("usersv0", str(username)):
-                self.log("Deleting account: {0}".format(username))
+            try:
                 # Delete userdata
-                self.files.delete_item("usersv0", str(username))
-                # Delete group chats
+                if not self.files.delete_item("usersv0", str(username)):
+                    return False, True
+                self.log("Deleting account: {0}".format(username))
+                self.delete_tokens(str(username))
+                with self.auth_cache_lock:
+                    self.username_cache.pop(username.lower(), None)
+                # Delete group chats, and leave the rest
                 self.files.db["chats"].delete_many({"owner": username})
-                chat_index = self.files.db["chats"].find({"members": {"$all": [username]}})
-                for chat in chat_index:
-                    chat["members"].remove(username)
-                    self.files.write_item("chats", chat["_id"], chat)
+                self.files.db["chats"].update_many({"members": username}, {"$pull": {"members": username}})
                 # Delete posts
                 self.files.db["posts"].delete_many({"u": username})
-                # Delete netlog data
-                netlog_index = self.files.db["netlog"].find({"users": {"$all": [username]}})
-                for ip in netlog_index:
-                    ip["users"].remove(username)
-                    if len(ip["users"]) == 0:
-                        self.files.delete_item("netlog", ip["_id"])
-                    else:
-                        if ip["last_user"] == username:
-                            ip["last_user"] = ip["users"][(len(ip["users"])-1)]
-                        self.files.write_item("netlog", ip["_id"], ip)
-                return True, True, True
-            else:
+                # Delete netlog data, IPs only the user used go and the rest get their last user moved back to someone else
+                self.files.db["netlog"].delete_many({"users": [username]})
+                self.files.db["netlog"].update_many({"users": username}, [
+                    {"$set": {"users": {"$filter": {"input": "$users", "cond": {"$ne": ["$$this", username]}}}}},
+                    {"$set": {"last_user": {"$cond": [{"$eq": ["$last_user", username]}, {"$arrayElemAt": ["$users", -1]}, "$last_user"]}}}
+                ])
+                return True, True
+            except Exception as e:
+                self.log("Error on delete_account: {0}".format(e))
                 return False, False
         else:
             self.log("Error on delete_account: Expected str for username, got {0} for username".format(type(username)))
@@ -1,10 +1,9 @@
 from datetime import datetime
-from better_profanity import profanity
+from better_profanity import profanity, Profanity
 import time
 import traceback
 import sys
 import string
-from threading import Thread
 
 """
 
@@ -18,6 +17,7 @@ This keeps the main.py clean and more understandable.
 class Supporter:
     def __init__(self, cl=None, packet_callback=None):
         self.filter = None
+        self.compiled_filter = None
         self.last_packet = {}
         self.burst_amount = {}
         self.ratelimits = {}
@@ -241,16 +241,26 @@ class Supporter:
         # Rate limiter
         self.modify_client_statedata(client, "last_packet", int(time.time()))
     
+    def get_compiled_filter(self):
+        # Builds the profanity filter from the config/filter document, only rebuilding when the document changes
+        filter_key = (tuple(self.filter["whitelist"]), tuple(self.filter["blacklist"]))
+        compiled = self.compiled_filter
+        if (compiled == None) or (compiled[0] != filter_key):
+            self.log("Compiling profanity filter")
+            censor = Profanity()
+            censor.load_censor_words(custom_words=(list(censor.CENSOR_WORDSET) + list(filter_key[1])), whitelist_words=list(filter_key[0]))
+            
+            # Swap the whole filter at once so other packet threads never see a half-loaded wordlist
+            compiled = (filter_key, censor)
+            self.compiled_filter = compiled
+        return compiled[1]
+    
     def wordfilter(self, message):
         # Word censor
         if self.filter != None:
-            self.profanity.load_censor_words(whitelist_words=self.filter["whitelist"])
-            message = self.profanity.censor(message)
-            self.profanity.load_censor_words(whitelist_words=self.filter["whitelist"], custom_words=self.filter["blacklist"])
-            message = self.profanity.censor(message)
+            message = self.get_compiled_filter().censor(message)
         else:
             self.log("Failed loading profanity filter : Using default filter as fallback")
-            self.profanity.load_censor_words()
             message = self.profanity.censor(message)
         return message
     
@@ -284,9 +294,8 @@ class Supporter:
     def autoID(self, client, username):
         if not self.cl == None:
             # really janky code that automatically sets user ID
-            self.modify_client_statedata(client, "username", username)
-            self.cl.statedata["ulist"]["usernames"][username] = client["id"]
-            self.sendPacket({"cmd": "ulist", "val": self.cl._get_ulist()})
+            if self.cl._add_username(client, username):
+                self.cl._send_ulist_update("ulist_add", username)
             self.log("{0} autoID given".format(username))
     
     def kickUser(self, username, status="Kicked"):
@@ -299,14 +308,12 @@ class Supporter:
 
                 # Unauthenticate client
                 client = self.cl.statedata["ulist"]["objs"][self.cl.statedata["ulist"]["usernames"][username]]["object"]
-                self.cl._closed_connection_server(client, None)
-                self.sendPacket({"cmd": "ulist", "val": self.cl._get_ulist()})
+                self.cl._remove_client(client)
                 
-                # Thread final closing
+                # Final closing after giving the client a second to receive the kick message
                 def run(client):
-                    time.sleep(1)
                     client["handler"].send_close(1000, bytes('', encoding='utf-8'))
-                Thread(target=run, args=(client,)).start()
+                self.cl.workers.submit_later(1, client["id"], run, client)
     
     def check_for_spam(self, type, client, burst=1, seconds=1):
         # Check if type and client are in ratelimit dictionary